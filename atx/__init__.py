@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+
 from atx.drivers.android import Application
 from atx.drivers.android import Device
 
@@ -8,15 +10,27 @@ version = '1.0'
 DEBUG = True
 
 
-def connect(serial=None, port=None, **kwargs):
+def _from_env(serial, port, host):
+    port = port or os.environ.get('ANDROID_ADB_SERVER_PORT')
+    return (serial or os.environ.get('ANDROID_SERIAL'),
+            int(port) if port else None,
+            host or os.environ.get('ANDROID_ADB_SERVER_ADDRESS'))
+
+
+def connect(serial=None, port=None, host=None, **kwargs):
     if len(kwargs) > 0 and DEBUG:
         print kwargs
-    app = Application(serial=serial, port=port)
+    # `atx run` hands every worker its device and adb server through the variables adb reads
+    serial, port, host = _from_env(serial, port, host)
+    app = Application(serial=serial, port=port, host=host)
     app.prepare()
     return app
 
 
-def machine(serial=None, port=None, **kwargs):
+def machine(serial=None, port=None, host=None, **kwargs):
     if len(kwargs) > 0 and DEBUG:
         print kwargs
-    return Device(serial=serial, port=port)
+    serial, port, host = _from_env(serial, port, host)
+    device = Device(serial=serial, port=port, host=host)
+    device.prepare()
+    return device
@@ -9,6 +9,7 @@ from __future__ import unicode_literals
 from __future__ import print_function
 
 import argparse
+import os
 import sys
 import inspect
 from contextlib import contextmanager
@@ -51,6 +52,23 @@ def main():
         p.add_argument('--scale', default=0.5, type=float, help='scale size')
         p.set_defaults(func=load_main('tkgui'))
 
+    with add_parser('run') as p:
+        p.description = 'Run the scripts of atx.yml on every attached device in parallel'
+        p.add_argument('-c', '--config', dest='config_file', default='atx.yml', help='config file')
+        p.add_argument('--mode', default='shard', choices=('all', 'shard'),
+                       help='all: every script on every device, shard: split scripts across devices')
+        p.add_argument('--log-dir', dest='log_dir', default='out/run', help='per job logs and summary.json')
+        p.add_argument('--history', dest='history_file', default=None,
+                       help='script durations of previous runs, <log-dir>/durations.json by default')
+        p.set_defaults(func=load_main('run'))
+
+    with add_parser('agent') as p:
+        p.description = 'Serve the devices attached to this host to a farm controller'
+        p.add_argument('--listen', default='127.0.0.1:17320', help='address the agent listens on')
+        p.add_argument('--token', default=os.environ.get('ATX_FARM_TOKEN'),
+                       help='shared secret controllers must send, $ATX_FARM_TOKEN by default')
+        p.set_defaults(func=load_main('agent'))
+
     args = ap.parse_args()
     if not hasattr(args, 'func'):
         print(' '.join(sys.argv) + ' -h for more help')
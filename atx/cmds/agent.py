@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# serve the devices of this host to a farm controller
+#
+# python -m atx agent --listen 0.0.0.0:17320 --token secret
+#
+from __future__ import absolute_import
+from __future__ import print_function
+
+from atx.drivers.farm import AGENT_PORT, FarmAgent
+
+
+def main(host=None, port=None, listen=None, token=None):
+    ip, _, agent_port = (listen or '').rpartition(':')
+    agent = FarmAgent((ip or '127.0.0.1', int(agent_port or AGENT_PORT)), host=host, port=port, token=token)
+    print('farm agent on %s:%d, adb server %s:%s' % (agent.server_address + (host, port)))
+    if token is None and not agent.server_address[0].startswith('127.'):
+        print('Warning: no --token, anyone who reaches this port can drive the attached devices')
+    try:
+        agent.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        agent.server_close()
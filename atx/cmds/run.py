@@ -13,19 +13,87 @@
 #   popo:
 #   - someone@example.com
 #
+# scripts run in parallel, one worker process per attached device, the device
+# serial reaches the script through ANDROID_SERIAL (atx.connect() picks it up).
+#
 from __future__ import absolute_import
 
 import os
+import re
 import sys
 import json
+import time
+import tempfile
+import collections
+import multiprocessing
 from argparse import Namespace
 
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    from urllib import urlretrieve
+except ImportError:
+    from urllib.request import urlretrieve
+
 import yaml
 try:
     import subprocess32 as subprocess
 except:
     import subprocess
 
+MODE_ALL = 'all'  # every script on every device
+MODE_SHARD = 'shard'  # every script once, on whichever device is free
+
+# exit code recorded for a job whose device went away and could not run it elsewhere
+CODE_OFFLINE = -2
+# seconds assumed for a script never seen before, long ones start early
+DEFAULT_DURATION = 60.0
+
+Job = collections.namedtuple('Job', ['script', 'serial'])
+Result = collections.namedtuple('Result', ['script', 'serial', 'code', 'duration', 'log'])
+
+
+class DurationHistory(object):
+    """
+    wall time of every script over previous runs, smoothed, kept as json next to the logs
+    """
+
+    def __init__(self, path=None, alpha=0.5):
+        self.path = path
+        self.alpha = alpha
+        self.durations = {}
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.durations = json.load(f)
+            except ValueError:
+                prompt("Ignore broken duration history %s" % path)
+
+    def expected(self, script):
+        if script in self.durations:
+            return self.durations[script]
+        # unknown scripts go first, that is where a wrong guess costs least
+        return max(list(self.durations.values()) + [DEFAULT_DURATION])
+
+    def update(self, results):
+        for r in results:
+            if r.code != 0:
+                continue
+            last = self.durations.get(r.script)
+            self.durations[r.script] = r.duration if last is None else \
+                self.alpha * r.duration + (1 - self.alpha) * last
+
+    def save(self):
+        if self.path is None:
+            return
+        if not os.path.exists(os.path.dirname(self.path) or '.'):
+            os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            json.dump(self.durations, f, indent=2, sort_keys=True)
+
 
 def json2obj(data):
     return json.loads(json.dumps(data), object_hook=lambda d: Namespace(**d))
@@ -44,15 +112,177 @@ def must_exec(*cmds, **kwargs):
         raise SystemExit("Execute '%s' error" % cmdline)
 
 
-def install(src):
-    prompt("Install")
-    must_exec('python', '-matx', 'install', src)
+def install(src, serials, host=None, port=None):
+    """
+    install the apk on every target device, src is a local path or an url fetched once
+    """
+    import atx.utils.adb as adb
+    prompt("Install %s" % src)
+    path = src
+    if re.match(r'^https?://', src):
+        path = os.path.join(tempfile.mkdtemp(prefix='atx_install_'), 'app.apk')
+        prompt("Download to %s" % path)
+        urlretrieve(src, path)
+    for serial in serials:
+        output = adb.run(serial=serial, port=port, host=host, cmd=["install", "-r", path])
+        if 'Success' not in output:
+            raise SystemExit("Install on %s failed: %s" % (serial, output.strip()))
+        prompt("Installed on %s" % serial)
+
+
+def adb_env(serial, host=None, port=None):
+    """
+    environment of a script run against serial, read back by atx.connect() and by adb itself
+    """
+    env = dict(os.environ, ANDROID_SERIAL=serial)
+    if host:
+        env['ANDROID_ADB_SERVER_ADDRESS'] = str(host)
+    if port:
+        env['ANDROID_ADB_SERVER_PORT'] = str(port)
+    return env
+
+
+def discover_devices(host=None, port=None):
+    """
+    @return serials of the devices adb reports as online
+    """
+    import atx.utils.adb as adb
+    return [serial for serial, state in adb.client(host=host, port=port).devices() if state == 'device']
 
 
-def runtest(scripts):
+def device_online(serial, host=None, port=None):
+    import atx.utils.adb as adb
+    try:
+        return adb.client(host=host, port=port).get_state(serial).strip() == 'device'
+    except IOError:
+        return False
+
+
+def plan(scripts, serials, mode=MODE_SHARD):
+    """
+    @return list of Job, serial None means any device
+    """
+    if mode == MODE_ALL:
+        return [Job(script, serial) for serial in serials for script in scripts]
+    return [Job(script, None) for script in scripts]
+
+
+def run_job(script, serial, log_dir, host=None, port=None):
+    """
+    run one script against serial in a pool worker, output goes to its own log file
+
+    @return Result
+    """
+    name = re.sub(r'[^\w.-]+', '_', script).strip('_')[:80] or 'script'
+    log = os.path.join(log_dir, re.sub(r'[^\w.-]+', '_', serial), name + '.log')
+    start = time.time()
+    try:
+        if not os.path.exists(os.path.dirname(log)):
+            os.makedirs(os.path.dirname(log))
+        env = adb_env(serial, host=host, port=port)
+        with open(log, 'wb') as f:
+            code = subprocess.Popen(script, shell=True, stdout=f, stderr=subprocess.STDOUT, env=env).wait()
+    except Exception as e:
+        # a worker must always answer, the scheduler waits for every job
+        code = -1
+        log = '%s (%s)' % (log, e)
+    return Result(script, serial, code, time.time() - start, log)
+
+
+def run_jobs(jobs, serials, log_dir='out/run', history=None, online=None, retries=2, host=None, port=None):
+    """
+    a pool with one worker per device, list scheduled: the longest expected job
+    goes to the least loaded free device. a job that fails on a device found
+    offline is queued again for the other devices, the device is dropped.
+
+    Args:
+        history: DurationHistory giving the expected time of each script
+        online: callable(serial) return False when the device is gone
+        retries: times one job may be moved off an offline device
+        host, port: adb server the scripts talk to
+    @return list of Result in finish order
+    """
+    history = history or DurationHistory()
+    pending = sorted(jobs, key=lambda j: -history.expected(j.script))
+    load = dict((serial, 0.0) for serial in serials)
+    idle = list(serials)
+    running = {}
+    moved = collections.Counter()
+    results = []
+    finished = queue.Queue()
+    pool = multiprocessing.Pool(len(serials))
+    try:
+        while pending or running:
+            for serial in sorted(idle, key=lambda s: load[s]):
+                job = next((j for j in pending if j.serial in (None, serial)), None)
+                if job is None:
+                    continue
+                pending.remove(job)
+                idle.remove(serial)
+                running[serial] = job
+                load[serial] += history.expected(job.script)
+                prompt("Start %s on %s" % (job.script, serial))
+                pool.apply_async(run_job, (job.script, serial, log_dir, host, port), callback=finished.put)
+            if not running:
+                break
+            try:
+                # a timeout keeps the wait interruptible by ctrl-c
+                result = finished.get(True, 1)
+            except queue.Empty:
+                continue
+            job = running.pop(result.serial)
+            if result.code != 0 and online is not None and not online(result.serial):
+                prompt("Device %s went offline" % result.serial)
+                del load[result.serial]
+                if job.serial is None and moved[job] < retries:
+                    moved[job] += 1
+                    pending.append(job)
+                    pending.sort(key=lambda j: -history.expected(j.script))
+                else:
+                    results.append(result._replace(code=CODE_OFFLINE))
+                continue
+            idle.append(result.serial)
+            results.append(result)
+            prompt("%s %s on %s in %.1fs" % ('Pass' if result.code == 0 else 'Fail', result.script,
+                                             result.serial, result.duration))
+    finally:
+        pool.close()
+        pool.join()
+    for job in pending:
+        results.append(Result(job.script, job.serial, CODE_OFFLINE, 0.0, 'no device left'))
+    return results
+
+
+def summary(results, log_dir='out/run'):
+    prompt("Summary")
+    for r in results:
+        status = 'PASS' if r.code == 0 else 'OFFLINE' if r.code == CODE_OFFLINE else 'FAIL'
+        print('%-7s %-20s %8.1fs  %s  (%s)' % (status, r.serial, r.duration, r.script, r.log))
+    failed = [r for r in results if r.code != 0]
+    print('%d passed, %d failed' % (len(results) - len(failed), len(failed)))
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+    with open(os.path.join(log_dir, 'summary.json'), 'w') as f:
+        json.dump([r._asdict() for r in results], f, indent=2)
+    return failed
+
+
+def runtest(scripts, serials=None, mode=MODE_SHARD, log_dir='out/run', host=None, port=None, history_file=None):
     prompt("Run scripts")
-    for script in scripts:
-        must_exec(script, shell=True)
+    if not serials:
+        serials = discover_devices(host=host, port=port)
+    if not serials:
+        raise SystemExit("No device online")
+    prompt("Devices %s, mode %s" % (', '.join(serials), mode))
+    history = DurationHistory(history_file or os.path.join(log_dir, 'durations.json'))
+    results = run_jobs(plan(scripts, serials, mode), serials, log_dir=log_dir, history=history,
+                       online=lambda serial: device_online(serial, host=host, port=port), host=host, port=port)
+    history.update(results)
+    history.save()
+    failed = summary(results, log_dir=log_dir)
+    if failed:
+        raise SystemExit("%d of %d jobs failed" % (len(failed), len(results)))
+    return results
 
 
 def notify_popo(users, message):
@@ -64,23 +294,26 @@ def notify_popo(users, message):
     # print users, message
 
 
-def main(config_file='atx.yml'):
+def main(config_file='atx.yml', mode=MODE_SHARD, serial=None, host=None, port=None, log_dir='out/run',
+         history_file=None):
     if not os.path.exists(config_file):
         sys.exit('config file (%s) not found.' % config_file)
 
     with open(config_file, 'rb') as f:
         cfg = json2obj(yaml.load(f))
-    
+
     try:
+        serials = serial.split(',') if serial else discover_devices(host=host, port=port)
         if hasattr(cfg, 'installation'):
-            install(cfg.installation)
+            install(cfg.installation, serials, host=host, port=port)
 
         if hasattr(cfg, 'script'):
             if isinstance(cfg.script, basestring):
                 scripts = [cfg.script]
             else:
                 scripts = cfg.script
-            runtest(scripts)
+            runtest(scripts, serials=serials, mode=mode, log_dir=log_dir, host=host, port=port,
+                    history_file=history_file)
     finally:
         if hasattr(cfg, 'notification'):
             if hasattr(cfg.notification, 'popo'):
@@ -88,4 +321,4 @@ def main(config_file='atx.yml'):
 
 
 if __name__ == '__main__':
-    main('atx.yml')
\ No newline at end of file
+    main('atx.yml')
@@ -443,9 +443,9 @@ class CropIDE(object):
         self._root.mainloop()
 
 
-def main(serial, host='127.0.0.1', scale=0.5):
+def main(serial, host='127.0.0.1', port=5037, scale=0.5):
     log.debug("gui starting(scale: {}) ...".format(scale))
-    device = atx.connect(serial, host=host, platform='android')
+    device = atx.connect(serial, host=host, port=port, platform='android')
     serial = device.serial
     gui = CropIDE('ATX GUI SN: %s' % serial, ratio=scale, device=device)
     gui.mainloop()
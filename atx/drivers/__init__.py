@@ -47,7 +47,8 @@ class ImageCrop(object):
 
 
 class Pattern(object):
-    def __init__(self, name, image=None, offset=None, anchor=0, rsl=None, resolution=None, th=None, threshold=None):
+    def __init__(self, name, image=None, offset=None, anchor=0, rsl=None, resolution=None, th=None, threshold=None,
+                 roi=None):
         """
         Args:
             name: image filename
@@ -58,6 +59,7 @@ class Pattern(object):
             rsl: alias of resolution
             threshold: image match threshold, usally (0, 1]
             th: alias of threshold
+            roi: only search this (left, top, right, bottom) area of the screen
         """
         if isinstance(name, ImageCrop):
             self._name = name.src
@@ -70,6 +72,8 @@ class Pattern(object):
         self._offset = offset
         self._resolution = rsl or resolution
         self._threshold = th or threshold
+        self._roi = roi
+        self._template = None
         if isinstance(image, six.string_types):
             self._name = image
 
@@ -103,11 +107,44 @@ class Pattern(object):
 
     @property
     def image(self):
+        if self._image is None or isinstance(self._image, six.string_types):
+            from atx.utils import images
+            return images.read_template(self._name, self._bound)
         if self._bound is None:
             return self._image
         else:
             return imutils.crop(self._image, *self._bound)
 
+    @property
+    def template(self):
+        """ matching ready image, see atx.utils.images.Template """
+        from atx.utils import images
+        if self._image is None or isinstance(self._image, six.string_types):
+            # Pattern(name, image=path) reads the same file as Pattern(path)
+            return images.template_cache.get(self._name, self._bound)
+        if self._template is None:
+            self._template = images.make_template(self.image)
+        return self._template
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def path(self):
+        """ file the image is read from, None for an in-memory image """
+        if self._image is None or isinstance(self._image, six.string_types):
+            return self._name
+        return None
+
+    @property
+    def roi(self):
+        return self._roi
+
+    @property
+    def bound(self):
+        return self._bound
+
     @property
     def offset(self):
         return self._offset
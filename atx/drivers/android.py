@@ -7,25 +7,103 @@ from __future__ import absolute_import
 import re
 import os
 import collections
+import contextlib
 import functools
 import inspect
 import traceback
 import tempfile
+import threading
 import time
+from multiprocessing.pool import ThreadPool
 from atx import imutils
-from atx.drivers import Pattern
+from atx.drivers import Pattern, FindPoint
 from atx import consts
 from atx.base import nameddict
 import atx.utils.texts as texts
 import atx.utils.adb as adb
+import atx.utils.touch as touch
 import atx.utils.images as images
+from atx.utils.device_store import DeviceTemplateStore
+from atx.utils.match_server import MatchClient, MatchRequestError, MatchServerError
 import atx.drivers.screen_mapping as mapping
+from atx.drivers.capture import Frame, FrameProducer, FrameHistory
+from atx.drivers.engines import EngineSelector, ENGINE_LOCAL, ENGINE_REMOTE
+from atx.drivers.waits import Tick, WaitResult, schedule
+from atx.drivers.watchers import InputLock, Watcher, WatcherRegistry
 from atx.utils.images import ImageNotFoundError
 
 Traceback = collections.namedtuple('Traceback', ['stack', 'exception'])
 HookEvent = nameddict('HookEvent', ['args', 'kwargs', 'tag', 'flag', 'result', 'traceback', 'done'])
 ACTION_TIME = 0.3
 
+# how tap/swipe/back/home wait for the UI after the input
+SETTLE_SLEEP = 'sleep'  # fixed ACTION_TIME
+SETTLE_FLIPS = 'flips'  # SurfaceFlinger stops composing frames
+SETTLE_FRAMES = 'frames'  # two captures in a row look the same
+SETTLE_AUTO = 'auto'  # flips, then frames, then sleep
+SETTLE_INTERVAL = 0.05
+SETTLE_QUIET = 0.15
+SETTLE_DIFF = 0.002
+# in SETTLE_AUTO a screen still changing after this long animates on its own (game, spinner, video)
+SETTLE_BUSY = ACTION_TIME
+# 'sendevent' writes touches to the touchscreen node, 'input' runs the input command
+TOUCH_INPUT = 'input'
+TOUCH_SENDEVENT = 'sendevent'
+TAP_TIME = 0.05
+SWIPE_TIME = 0.3
+MATCH_THREADS = 4
+MATCH_SERVER_PORT = 17310
+
+_match_pool = None
+
+
+def match_pool():
+    """
+    threads shared by every Application, opencv releases the GIL while matching
+    """
+    global _match_pool
+    if _match_pool is None:
+        _match_pool = ThreadPool(MATCH_THREADS)
+    return _match_pool
+
+
+class FlipSettle(object):
+    """
+    decide when the frame counter went quiet, shared by the blocking and the coroutine driver
+
+        settle = FlipSettle(first_count, deadline, busy)
+        while not settle.update(read_count()):
+            sleep(SETTLE_INTERVAL)
+
+    quiet tells afterwards whether the counter stopped or the wait gave up
+
+    Args:
+        deadline: time.time() to give up at
+        busy: seconds of uninterrupted flips after which the screen counts as animating, None to wait for deadline
+    """
+
+    def __init__(self, count, deadline, busy=None):
+        self.quiet = False
+        self.last = count
+        self.deadline = deadline
+        self.start = time.time()
+        self.quiet_since = self.start
+        self.busy = busy
+
+    def update(self, count):
+        """
+        @return True when done waiting
+        """
+        now = time.time()
+        if count != self.last:
+            self.last, self.quiet_since = count, now
+        elif now - self.quiet_since >= SETTLE_QUIET:
+            self.quiet = True
+            return True
+        if self.busy is not None and now - self.start >= self.busy:
+            return True
+        return now >= self.deadline
+
 
 def hook_wrap(event_type):
     def wrap(fn):
@@ -54,6 +132,8 @@ def hook_wrap(event_type):
                 return _result
             except Exception as e:
                 _traceback = Traceback(traceback.format_exc(), e)
+                if getattr(e, 'postmortem', None) is None:
+                    e.postmortem = self.dump_history(fn.__name__)
                 raise
             finally:
                 trigger(HookEvent(done=True))
@@ -64,18 +144,25 @@ def hook_wrap(event_type):
 
 
 class Device(object):
-    def __init__(self, serial=None, port=None):
+    def __init__(self, serial=None, port=None, host=None):
         self.serial = serial
         self.port = port
+        self.host = host
+
+    def prepare(self):
+        adb.open_session(serial=self.serial, port=self.port, host=self.host)
+
+    def close(self):
+        adb.close_session(serial=self.serial, port=self.port, host=self.host)
 
     def cpu_usage(self):
-        return adb.cpu_usage(serial=self.serial, port=self.port)
+        return adb.cpu_usage(serial=self.serial, port=self.port, host=self.host)
 
     def mem_usage(self):
-        return adb.mem_usage(serial=self.serial, port=self.port)
+        return adb.mem_usage(serial=self.serial, port=self.port, host=self.host)
 
     def temperature(self):
-        return adb.temperature(serial=self.serial, port=self.port)
+        return adb.temperature(serial=self.serial, port=self.port, host=self.host)
 
     def running_instance(self):
         pass
@@ -90,37 +177,66 @@ class Device(object):
         pass
 
     def power_off(self):
-        adb.power_off(serial=self.serial, port=self.port)
+        adb.power_off(serial=self.serial, port=self.port, host=self.host)
 
     def power_on(self):
         pass
 
     def reboot(self):
-        adb.reboot(serial=self.serial, port=self.port)
+        adb.reboot(serial=self.serial, port=self.port, host=self.host)
 
 
 class Application(object):
-    def __init__(self, serial=None, port=None):
+    def __init__(self, serial=None, port=None, host=None):
         self._listeners = []
         self.identity = None
         self.serial = serial
         self.port = port
+        self.host = host
         self.instance = None
         self.display_id = None
         self.package = None
         self.activity = None
         self.resource_path = None
         self.cache_image = None
+        self.raw_capture = True
+        self._producer = None
+        self._consumed = threading.local()
+        self._last_frame = None
+        self.history = FrameHistory()
+        self.hits = images.HitMemory()
+        self.gate = images.MatchGate()
+        self.device_store = DeviceTemplateStore(serial, port, host=host)
+        self._match_client = None
+        self._server_templates = {}
+        self.settle_mode = SETTLE_AUTO
+        self.settle_timeout = 2.0
+        self._flips_supported = None
+        self.touch_mode = TOUCH_INPUT
+        self._touch_screen = None
+        self._activity = None
+        self.postmortem_dir = 'out/postmortem'
         # adapt to old api
         self.display = (1920, 1080)
-        self.local_only = True
+        # remote matching needs the `cv` binary on the device, enabled by prepare()
+        self.engines = EngineSelector()
+        self.engines.enable(ENGINE_REMOTE, False)
+        self.input_lock = InputLock()
+        self.watchers = WatcherRegistry(frames=self.last_frame,
+                                        locate=self.__watch_locate,
+                                        act=lambda pos: self.tap(*pos),
+                                        lock=self.input_lock,
+                                        name='watcher-%s' % serial)
 
     def info(self):
         pass
 
     def prepare(self):
-        if len(adb.which(serial=self.serial, port=self.port, which_cmd="cv").strip()) == 0:
-            self.local_only = False
+        adb.open_session(serial=self.serial, port=self.port, host=self.host)
+        remote = len(adb.which(serial=self.serial, port=self.port, host=self.host, which_cmd="cv").strip()) > 0
+        self.engines.enable(ENGINE_REMOTE, remote)
+        if remote:
+            self.device_store.sync()
 
     def attach(self, package=None, activity=None, resource_path=None, instance=None, display_id=None, identity=None):
         self.package = package
@@ -130,8 +246,39 @@ class Application(object):
         self.resource_path = resource_path  # r"tasks/res/%s/%s@auto.png"
         self.identity = identity
 
+    def use_match_server(self, local_port, remote_port=MATCH_SERVER_PORT, retry=10):
+        """
+        start the on-device match server and reach it through adb forward,
+        remote matches then reuse preloaded templates instead of running `cv match`
+
+        the forwarded port listens on the adb server host, a remote adb server
+        has to be started with `adb -a` to accept it from this machine
+        """
+        adb.start_match_server(serial=self.serial, port=self.port, host=self.host, remote_port=remote_port)
+        adb.forward(serial=self.serial, port=self.port, host=self.host, local_port=local_port, remote_port=remote_port)
+        host = self.host or '127.0.0.1'
+        client = MatchClient(host=host, port=local_port)
+        for i in range(retry):
+            try:
+                client.ping()
+                break
+            except (IOError, MatchServerError):
+                time.sleep(0.2)
+        else:
+            raise IOError("match server not reachable on %s:%d" % (host, local_port))
+        self._match_client = client
+        self._server_templates = {}
+
+    def close(self):
+        self.watchers.stop()
+        if self._match_client is not None:
+            self._match_client.close()
+            self._match_client = None
+        self.stop_capture()
+        adb.close_session(serial=self.serial, port=self.port, host=self.host)
+
     def connect(self):
-        adb.connect(serial=self.serial, port=self.port)
+        adb.connect(serial=self.serial, port=self.port, host=self.host)
 
     def add_listener(self, fn, event_flags):
         self._listeners.append((fn, event_flags))
@@ -149,6 +296,7 @@ class Application(object):
             raise ValueError("app info should be attach before call lunch")
         adb.am_start(serial=self.serial,
                      port=self.port,
+                     host=self.host,
                      package_name=self.package,
                      activity_name=self.activity,
                      instance=self.instance)
@@ -159,75 +307,295 @@ class Application(object):
             raise ValueError("app info should be attach before call stop")
         adb.am_force_stop(serial=self.serial,
                           port=self.port,
+                          host=self.host,
                           package_name=self.package,
                           instance=self.instance)
 
     @hook_wrap(consts.EVENT_SWIPE)
     def swipe(self, x1, y1, x2, y2):
-        adb.swipe(serial=self.serial,
-                  port=self.port,
-                  instance=self.instance,
-                  x1=x1,
-                  y1=y1,
-                  x2=x2,
-                  y2=y2)
-        time.sleep(ACTION_TIME)
+        with self.input_lock:
+            if not self.__send_touch([[(x1, y1), (x2, y2)]], SWIPE_TIME):
+                adb.swipe(serial=self.serial,
+                          port=self.port,
+                          host=self.host,
+                          instance=self.instance,
+                          x1=x1,
+                          y1=y1,
+                          x2=x2,
+                          y2=y2)
+            self.input_lock.touch()
+            self.settle()
 
     def tap(self, x, y):
-        adb.tap(serial=self.serial,
-                port=self.port,
-                instance=self.instance,
-                x=x,
-                y=y)
-        time.sleep(ACTION_TIME)
+        with self.input_lock:
+            if not self.__send_touch([[(x, y)]], TAP_TIME):
+                adb.tap(serial=self.serial,
+                        port=self.port,
+                        host=self.host,
+                        instance=self.instance,
+                        x=x,
+                        y=y)
+            self.input_lock.touch()
+            self.settle()
+
+    def gesture(self, *paths, **kwargs):
+        """
+        multi-finger gesture, one list of (x, y) points per finger, e.g. a pinch:
+
+            app.gesture([(300, 800), (500, 800)], [(900, 800), (700, 800)], duration=0.5)
+
+        needs touch_mode = TOUCH_SENDEVENT and write access to the touchscreen node
+        """
+        duration = kwargs.pop('duration', SWIPE_TIME)
+        if kwargs:
+            raise TypeError("unexpected arguments %s" % ', '.join(kwargs))
+        with self.input_lock:
+            if not self.__send_touch([list(p) for p in paths], duration):
+                if len(paths) != 1 or len(paths[0]) != 2:
+                    raise IOError("multi-finger gestures need sendevent access to the touchscreen")
+                (x1, y1), (x2, y2) = paths[0]
+                adb.swipe(serial=self.serial, port=self.port, host=self.host, instance=self.instance,
+                          x1=x1, y1=y1, x2=x2, y2=y2)
+            self.input_lock.touch()
+            self.settle()
+
+    def __send_touch(self, paths, duration):
+        """
+        @return False when the input command has to do it instead
+        """
+        if self.touch_mode != TOUCH_SENDEVENT or self._touch_screen is False:
+            return False
+        try:
+            if self._touch_screen is None:
+                # the node and axis ranges do not change, look them up once; send() reads the rotation each time
+                self._touch_screen = touch.discover(serial=self.serial, port=self.port, host=self.host) or False
+                if self._touch_screen is False:
+                    return False
+            if touch.send(serial=self.serial, port=self.port, host=self.host, screen=self._touch_screen,
+                          paths=paths, duration=duration):
+                return True
+            self._touch_screen = False
+        except IOError:
+            pass
+        return False
 
     @hook_wrap(consts.EVENT_TYPE)
     def type(self, msg):
-        adb.type(serial=self.serial,
-                 port=self.port,
-                 instance=self.instance,
-                 message=msg)
+        with self.input_lock:
+            adb.type(serial=self.serial,
+                     port=self.port,
+                     host=self.host,
+                     instance=self.instance,
+                     message=msg)
+            self.input_lock.touch()
 
     def clear_type(self, count=20):
-        while count > 0:
-            adb.del_input(serial=self.serial, port=self.port, instance=self.instance)
-            count = count - 1
+        with self.batch(settle=False) as b:
+            b.key_event("KEYCODE_DEL", repeat=count)
+
+    @contextlib.contextmanager
+    def batch(self, settle=True):
+        """
+        queue input and send it as one shell command when the block ends, see adb.InputBatch
+
+            with app.batch() as b:
+                b.tap(100, 200)
+                b.sleep(0.1)
+                b.text("hello")
+        """
+        batch = adb.InputBatch(serial=self.serial, port=self.port, host=self.host)
+        yield batch
+        if not len(batch):
+            return
+        with self.input_lock:
+            batch.flush()
+            self.input_lock.touch()
+            if settle:
+                self.settle()
 
     def screen_image(self):
+        """
+        @return pillow image, converted from screen_frame() only when asked for
+        """
+        return imutils.to_pillow(self.screen_frame())
+
+    def start_capture(self, interval=0.0):
+        """
+        grab frames continuously in background, screen_frame() and the polling loops
+        then consume the newest frame instead of capturing on their own
+        """
+        if self._producer is None:
+            self._producer = FrameProducer(lambda: self.__capture_frame().image, interval=interval,
+                                           name='capture-%s' % self.serial)
+        self._producer.start()
+
+    def stop_capture(self):
+        if self._producer is not None:
+            self._producer.stop()
+            self._producer = None
+
+    def last_frame(self, max_age=None):
+        """
+        @return the newest full size Frame captured by anyone, or None
+        """
+        frame = self._last_frame
+        if frame is None or (max_age is not None and time.time() - frame.timestamp > max_age):
+            return None
+        return frame
+
+    def dump_history(self, name='postmortem'):
+        """
+        write recent frames to postmortem_dir
+
+        @return zip path or None
+        """
+        if self.history is None or self.postmortem_dir is None:
+            return None
+        try:
+            return self.history.dump(self.postmortem_dir, name=name)
+        except (IOError, OSError) as e:
+            print("Warning: postmortem not saved, Error {}".format(e))
+            return None
+
+    def grab_frame(self, newer_than=0, timeout=15):
+        """
+        @return Frame captured after newer_than
+        """
+        if self._producer is not None and self._producer.running:
+            return self._producer.wait_newer(newer_than, timeout=timeout)
+        return self.__capture_frame()
+
+    def screen_frame(self):
+        """
+        @return opencv BGR image of the visible area, never the same frame twice for one thread
+        """
+        frame = self.grab_frame(newer_than=getattr(self._consumed, 'timestamp', 0))
+        self._consumed.timestamp = frame.timestamp
+        return frame.image
+
+    def __capture_frame(self):
+        start = time.time()
+        image = self.__capture_image()
+        frame = Frame(image, start, 0)
+        self._last_frame = frame
+        if self.history is not None:
+            self.history.append(image, start)
+        return frame
+
+    def __capture_image(self):
+        if self.raw_capture:
+            try:
+                data = adb.screen_cap_raw(serial=self.serial,
+                                          port=self.port,
+                                          host=self.host,
+                                          display_id=self.display_id)
+                return images.from_raw(data, mapping.visible_area())
+            except images.RawFormatError:
+                # screencap output this decoder does not know, keep the png path for this device.
+                # other IOErrors (device briefly offline, short read) only fail this capture
+                self.raw_capture = False
+        return self.__screen_frame_png()
+
+    def __screen_frame_png(self):
         phone_tmp_file = self.__remote_tmp_path()
         local_tmp_file = self.__local_tmp_path()
         try:
             adb.screen_cap(serial=self.serial,
                            port=self.port,
+                           host=self.host,
                            remote_path=phone_tmp_file,
                            display_id=self.display_id)
             adb.pull(serial=self.serial,
                      port=self.port,
+                     host=self.host,
                      remote_path=phone_tmp_file,
                      local_path=local_tmp_file)
-            return images.read(local_tmp_file, mapping.visible_area())
+            return images.read_array(local_tmp_file, mapping.visible_area())
         except IOError as error:
             raise IOError("Screenshot failed:%s" % error)
         finally:
-            adb.rm(serial=self.serial, port=self.port, remote_path=phone_tmp_file)
+            adb.rm(serial=self.serial, port=self.port, host=self.host, remote_path=phone_tmp_file)
             self.__remove_local_file(local_tmp_file)
 
     def tap_image(self, key=None, local_object_path=None, timeout=15, frequency=0.2):
-        if self.local_only:
-            return self.__tap_image_remote(local_object_path=self.__get_path(key, local_object_path),
-                                           timeout=timeout,
-                                           frequency=frequency)
-        else:
-            return self.__tap_image_local(local_object_path=self.__get_path(key, local_object_path),
-                                          timeout=timeout,
-                                          frequency=frequency)
+        return self.__tap_image(local_object_path=self.__get_path(key, local_object_path),
+                                timeout=timeout,
+                                frequency=frequency)
 
     def exists(self, key=None, local_object_path=None):
-        local_object_path = self.__get_path(key, local_object_path)
-        if self.local_only:
-            self.__exist_remote(local_object_path=local_object_path)
-        else:
-            self.__exist_local(local_object_path=local_object_path)
+        return self.__exist(local_object_path=self.__get_path(key, local_object_path))
+
+    def engine_stats(self):
+        """
+        @return current match engine and rolling latency of each engine, for monitoring
+        """
+        return self.engines.stats()
+
+    def find_all(self, keys=None, local_object_paths=None):
+        """
+        capture once and match every template against that frame in parallel
+
+        @return dict key or path -> FindPoint, None when not found
+        """
+        targets = [(k, self.__get_path(key=k)) for k in keys or []] + \
+                  [(p, p) for p in local_object_paths or []]
+        paths = [path for _, path in targets]
+        engine = self.__choose_engine(paths)
+        start = time.time()
+        results = None
+        if engine == ENGINE_REMOTE:
+            try:
+                positions = self.__remote_positions(paths)
+                results = [None if pos is None else FindPoint(pos, None, ENGINE_REMOTE, True) for pos in positions]
+            except (IOError, OSError):
+                # broken `cv` or a failed push, the local engine answers this time
+                self.engines.fail(ENGINE_REMOTE)
+                engine, start = ENGINE_LOCAL, time.time()
+        if results is None:
+            results = self.__find_all_local(paths)
+        self.engines.record(engine, (time.time() - start) / max(1, len(targets)))
+        return dict((name, ret) for (name, _), ret in zip(targets, results))
+
+    def __find_all_local(self, targets):
+        scene = images.Scene(self.screen_frame()).prepare()
+
+        def _find(target):
+            ret = self.__find_local(target, scene)
+            if ret is None:
+                return None
+            return FindPoint(mapping.computer(*ret.pos), ret.confidence, images.MATCH_ENGINE, True)
+
+        return match_pool().map(_find, targets)
+
+    def __remote_positions(self, targets):
+        """
+        @return list of tap position or None on one device capture
+        @raise IOError, OSError when the templates can not be pushed or `cv` fails
+        """
+        remote_targets = [self.device_store.ensure(self.__object_path(t)) for t in targets]
+        return self.__match_remote_many(remote_targets, [self.__threshold(t) for t in targets])
+
+    def __choose_engine(self, targets):
+        """
+        the remote engine only when it gives the same answer as the local one for every target
+        """
+        for target in targets:
+            if isinstance(target, Pattern) and (target.path is None or target.bound is not None or
+                                                target.roi is not None or
+                                                (target.threshold is not None and self._match_client is None)):
+                # in-memory image, crop or roi: `cv match` knows none of them, nor thresholds
+                return ENGINE_LOCAL
+        return self.engines.choose()
+
+    def find_any(self, keys=None, local_object_paths=None):
+        """
+        @return (key or path, FindPoint) of the first target found in order, None when nothing found
+        """
+        found = self.find_all(keys=keys, local_object_paths=local_object_paths)
+        for name in list(keys or []) + list(local_object_paths or []):
+            if found.get(name) is not None:
+                return name, found[name]
+        return None
 
     def wait_image(self, key=None, local_object_path=None, timeout=15, frequency=0.2):
         start_time = time.time()
@@ -235,7 +603,7 @@ class Application(object):
             if self.exists(key=key, local_object_path=local_object_path):
                 return
             else:
-                time.sleep(frequency)
+                self.__poll_sleep(frequency)
 
     def wait_image_gone(self, key=None, local_object_path=None, timeout=15, frequency=0.2):
         start_time = time.time()
@@ -243,89 +611,315 @@ class Application(object):
             if not self.exists(key=key, local_object_path=local_object_path):
                 return
             else:
-                time.sleep(frequency)
+                self.__poll_sleep(frequency)
+
+    def wait_for(self, *conditions, **kwargs):
+        """
+        poll until one of the conditions is met, see atx.drivers.waits
+
+            app.wait_for(ImageExists('ok.png'), ImageExists('retry.png'), ActivityIs('com.x/.Main'))
+
+        every tick captures once for all image conditions, the top activity and the
+        ui hierarchy are read only when a condition asks for them.
+
+        Args:
+            timeout: seconds, 15 by default
+            backoff: waits.Backoff, seconds or a list of seconds between ticks
+        @return WaitResult(index, condition, value) of the first condition met, None on timeout
+        """
+        timeout = kwargs.pop('timeout', 15)
+        delays = schedule(kwargs.pop('backoff', None))
+        if kwargs:
+            raise TypeError("unexpected arguments %s" % ', '.join(kwargs))
+        targets = []
+        for condition in conditions:
+            targets.extend(t for t in condition.targets if t not in targets)
+        deadline = time.time() + timeout
+        while True:
+            tick_start = time.time()
+            tick = self.__tick(targets)
+            for index, condition in enumerate(conditions):
+                value = condition.evaluate(tick)
+                if value is not None and value is not False:
+                    return WaitResult(index, condition, value)
+            delay = next(delays) - (time.time() - tick_start)
+            if time.time() + max(delay, 0) >= deadline:
+                return None
+            if delay > 0:
+                time.sleep(delay)
+
+    def __tick(self, targets):
+        screen = []
+
+        def _screen():
+            if not screen:
+                screen.append(self.screen_frame())
+            return screen[0]
+
+        positions = {}
+        if targets:
+            engine = self.__choose_engine(targets)
+            start = time.time()
+            if engine == ENGINE_REMOTE:
+                try:
+                    positions = dict(zip(targets, self.__remote_positions(targets)))
+                except (IOError, OSError):
+                    self.engines.fail(ENGINE_REMOTE)
+                    engine, start = ENGINE_LOCAL, time.time()
+            if engine == ENGINE_LOCAL:
+                for t in targets:
+                    pos = self.__locate_local(t, _screen())
+                    positions[t] = None if pos is self.__SKIPPED else pos
+            self.engines.record(engine, (time.time() - start) / len(targets))
+        return Tick(positions, _screen, self.__top_activity,
+                    lambda: adb.ui_dump(serial=self.serial, port=self.port, host=self.host))
+
+    def __top_activity(self):
+        try:
+            return self.current_activity()
+        except RuntimeError:
+            return None
+
+    def settle(self, timeout=None):
+        """
+        return as soon as the UI is stable after an input, waiting at most timeout
+        (settle_timeout by default) over all phases; falls back to the fixed ACTION_TIME
+        sleep when neither frame counters nor captures are available
+
+        @return True when the UI went quiet, False when it gave up
+        """
+        start = time.time()
+        deadline = start + (self.settle_timeout if timeout is None else timeout)
+        mode = self.settle_mode
+        # auto gives up on a screen that never goes quiet after about the old fixed sleep
+        busy = SETTLE_BUSY if mode == SETTLE_AUTO else None
+        try:
+            if mode in (SETTLE_AUTO, SETTLE_FLIPS) and self._flips_supported is not False:
+                quiet = self.__settle_flips(deadline, busy)
+                if quiet is not None:
+                    return quiet
+            if mode in (SETTLE_AUTO, SETTLE_FRAMES):
+                return self.__settle_frames(deadline if busy is None else min(deadline, start + busy))
+        except IOError:
+            pass
+        time.sleep(max(0, min(ACTION_TIME - (time.time() - start), deadline - time.time())))
+        return False
+
+    def __settle_flips(self, deadline, busy=None):
+        """
+        @return True when the counter went quiet, False when it gave up, None without a counter
+        """
+        time.sleep(SETTLE_INTERVAL)
+        count = self.__flip_count(deadline)
+        self._flips_supported = count is not None
+        if count is None:
+            return None
+        settle = FlipSettle(count, deadline, busy)
+        while True:
+            time.sleep(SETTLE_INTERVAL)
+            if settle.update(self.__flip_count(deadline)):
+                return settle.quiet
+
+    def __flip_count(self, deadline):
+        # a hung probe must not hold the input past the settle deadline
+        return adb.surface_flip_count(serial=self.serial, port=self.port, host=self.host,
+                                      timeout=max(0.1, deadline - time.time()))
+
+    def __settle_frames(self, deadline):
+        start = time.time()
+        if start >= deadline:
+            return False
+        prev = self.grab_frame(newer_than=start, timeout=max(0.1, deadline - time.time()))
+        while time.time() < deadline:
+            frame = self.grab_frame(newer_than=prev.timestamp, timeout=max(0.1, deadline - time.time()))
+            if frame.timestamp - prev.timestamp >= SETTLE_INTERVAL and \
+                    imutils.diff_ratio(prev.image, frame.image) <= SETTLE_DIFF:
+                return True
+            prev = frame
+        return False
 
     def back(self):
-        adb.back(serial=self.serial, port=self.port, instance=self.instance)
-        time.sleep(ACTION_TIME)
+        with self.input_lock:
+            adb.back(serial=self.serial, port=self.port, host=self.host, instance=self.instance)
+            self.input_lock.touch()
+            self.settle()
 
     def home(self):
-        adb.home(serial=self.serial, port=self.port, instance=self.instance)
-        time.sleep(ACTION_TIME)
+        with self.input_lock:
+            adb.home(serial=self.serial, port=self.port, host=self.host, instance=self.instance)
+            self.input_lock.touch()
+            self.settle()
+
+    def watch(self, name, key=None, local_object_path=None, action=None, interval=1.0):
+        """
+        dismiss popups in background: whenever the image shows up on a frame the
+        script captured anyway, run action(pos) or tap on it
+
+        watchers only see frames that screen_frame(), the polling loops or
+        start_capture() produce, nothing is captured for them alone.
+
+        @return Watcher, Watcher.wait(timeout) blocks until it fired
+        """
+        watcher = self.watchers.add(Watcher(name, self.__get_path(key, local_object_path), action, interval))
+        self.watchers.start()
+        return watcher
+
+    def unwatch(self, name):
+        self.watchers.remove(name)
+        if not self.watchers.names():
+            self.watchers.stop()
+
+    def __watch_locate(self, target, image):
+        pos = self.__locate_local(target, image)
+        return None if pos is self.__SKIPPED else pos
 
     @hook_wrap(consts.EVENT_ASSERT_EXISTS)
-    def __exist_local(self, local_object_path=None):
-        try:
-            images.match(target=local_object_path,
-                         scanner=self.screen_image())
-            return True
-        except ImageNotFoundError:
-            return False
+    def __exist(self, local_object_path=None):
+        return self.__attempt(local_object_path) is not None
 
     @hook_wrap(consts.EVENT_CLICK_IMAGE)
-    def __tap_image_local(self, local_object_path=None, timeout=15.0, frequency=0.2):
-        target = images.read(local_object_path)
+    def __tap_image(self, local_object_path=None, timeout=15.0, frequency=0.2):
         start_time = time.time()
         while time.time() - start_time < timeout:
-            try:
-                x, y = images.match(target, self.screen_image())
-                x, y = mapping.computer(x, y)
+            pos = self.__attempt(local_object_path)
+            if pos is not None:
+                x, y = pos
                 self.tap(x, y)
                 return x, y
-            except ImageNotFoundError:
-                time.sleep(frequency)
-                pass
-        del target
+            self.__poll_sleep(frequency)
         raise ImageNotFoundError('Not found image %s' % local_object_path)
 
-    @hook_wrap(consts.EVENT_ASSERT_EXISTS)
-    def __exist_remote(self, local_object_path=None):
-        remote_target = self.__remote_tmp_path(True)
-        adb.push(serial=self.serial, port=self.port, local_path=local_object_path, remote_path=remote_target)
-        screen = self.__remote_tmp_path()
-        try:
-            adb.screen_cap(serial=self.serial,
-                           port=self.port,
-                           remote_path=screen,
-                           display_id=self.display_id)
-            cv = adb.match(serial=self.serial,
-                           port=self.port,
-                           remote_object_path=remote_target,
-                           remote_scanner_path=screen)
-            mapping.computer_match(cv)
-            return True
-        except (IOError, ImageNotFoundError):
-            pass
-        finally:
-            adb.rm(serial=self.serial, port=self.port, remote_path=screen)
-            adb.rm(serial=self.serial, port=self.port, remote_path=remote_target)
-        return False
+    def __attempt(self, target):
+        """
+        capture and match once on the engine that is currently cheaper
 
-    @hook_wrap(consts.EVENT_CLICK_IMAGE)
-    def __tap_image_remote(self, local_object_path=None, timeout=15, frequency=0.2):
-        remote_target = self.__remote_tmp_path(True)
-        adb.push(serial=self.serial, port=self.port, local_path=local_object_path, remote_path=remote_target)
-        start_time = time.time()
-        while time.time() - start_time < timeout:
+        @return tap position or None
+        """
+        engine = self.__choose_engine([target])
+        start = time.time()
+        if engine == ENGINE_REMOTE:
             try:
-                screen = self.__remote_tmp_path()
-                adb.screen_cap(serial=self.serial,
-                               port=self.port,
-                               remote_path=screen,
-                               display_id=self.display_id)
-                cv = adb.match(serial=self.serial,
-                               port=self.port,
-                               remote_object_path=remote_target,
-                               remote_scanner_path=screen)
-                x, y = mapping.computer_match(cv)
-                self.tap(x, y)
-                return x, y
-            except (IOError, ImageNotFoundError):
-                time.sleep(frequency)
-            finally:
-                adb.rm(serial=self.serial, port=self.port, remote_path=screen)
-        adb.rm(serial=self.serial, port=self.port, remote_path=remote_target)
-        raise ImageNotFoundError('Not found image %s' % local_object_path)
+                pos = self.__remote_positions([target])[0]
+                self.engines.record(ENGINE_REMOTE, time.time() - start)
+                return pos
+            except (IOError, OSError):
+                # broken `cv` or a failed push, the local engine answers this time
+                self.engines.fail(ENGINE_REMOTE)
+                start = time.time()
+        pos = self.__locate_local(target, self.screen_frame())
+        if pos is self.__SKIPPED:
+            # a skipped match says nothing about the engine cost
+            return None
+        self.engines.record(ENGINE_LOCAL, time.time() - start)
+        return pos
+
+    __SKIPPED = object()
+
+    def __locate_local(self, target, screen):
+        """
+        @return tap position, None when not found, __SKIPPED when the region did not change since the last miss
+        """
+        key, roi = self.__gate_key(target)
+        signature = self.gate.signature(screen, roi)
+        if self.gate.unchanged(key, roi, signature):
+            return self.__SKIPPED
+        ret = self.__find_local(target, screen)
+        if ret is None:
+            self.gate.miss(key, roi, signature)
+            return None
+        self.gate.hit(key, roi)
+        return mapping.computer(*ret.pos)
+
+    @staticmethod
+    def __gate_key(target):
+        """
+        @return (key, roi) telling apart everything that can change the match result
+        """
+        if isinstance(target, Pattern):
+            roi = tuple(target.roi) if target.roi is not None else None
+            return (target.name, target.bound, target.threshold), roi
+        return (target, None, None), None
+
+    def __find_local(self, target, screen):
+        """
+        Args:
+            target: image path or Pattern
+            screen: image or images.Scene
+        @return images.MatchResult or None
+        """
+        if isinstance(target, Pattern):
+            return images.find_hinted(target.template, screen, key=target.name, context=self._activity,
+                                      roi=target.roi, threshold=target.threshold, memory=self.hits)
+        return images.find_hinted(target, screen, key=target, context=self._activity, memory=self.hits)
+
+    @staticmethod
+    def __object_path(target):
+        return target.path if isinstance(target, Pattern) else target
+
+    @staticmethod
+    def __threshold(target):
+        return target.threshold if isinstance(target, Pattern) else None
+
+    def __match_remote_many(self, remote_targets, thresholds=None):
+        """
+        match every remote template against one device capture
+
+        Args:
+            thresholds: one per remote target, None for the default
+        @return list of tap position or None, in the order of remote_targets
+        """
+        if self._match_client is not None:
+            thresholds = [t or images.match_threshold() for t in thresholds or [None] * len(remote_targets)]
+            try:
+                ids = []
+                for remote_target in remote_targets:
+                    template_id = self._server_templates.get(remote_target)
+                    if template_id is None:
+                        template_id = len(self._server_templates) + 1
+                        self._match_client.load(template_id, remote_target)
+                        self._server_templates[remote_target] = template_id
+                    ids.append(template_id)
+                # one capture for every template: the server reports down to the lowest
+                # threshold, each target is held to its own one here
+                records = self._match_client.match(ids, display_id=self.display_id, threshold=min(thresholds))
+                return [mapping.from_screen(*r.pos) if r.found and r.confidence > t else None
+                        for r, t in zip(records, thresholds)]
+            except MatchRequestError:
+                # e.g. a template the server can not load, the connection is fine
+                pass
+            except IOError:
+                # server died or hung, keep going with `cv match`
+                self._match_client.close()
+                self._match_client = None
+        if len(remote_targets) == 1:
+            outputs = {remote_targets[0]: adb.capture_match(serial=self.serial,
+                                                            port=self.port,
+                                                            host=self.host,
+                                                            remote_object_path=remote_targets[0],
+                                                            display_id=self.display_id)}
+        else:
+            outputs = adb.capture_match_many(serial=self.serial,
+                                             port=self.port,
+                                             host=self.host,
+                                             remote_object_paths=remote_targets,
+                                             display_id=self.display_id)
+        positions = []
+        for remote_target in remote_targets:
+            output = outputs.get(remote_target)
+            if not output or not output.strip():
+                # no `cv match` output for it, or the capture itself failed
+                positions.append(None)
+                continue
+            try:
+                positions.append(mapping.computer_match(output))
+            except ImageNotFoundError:
+                positions.append(None)
+        return positions
+
+    def __poll_sleep(self, frequency):
+        # with a running producer the next screen_frame() already waits for a fresh frame
+        if self._producer is None or not self._producer.running:
+            time.sleep(frequency)
 
     def __get_path(self, key=None, local_object_path=None):
         if key is None and local_object_path is None:
@@ -390,12 +984,14 @@ class Application(object):
 
     def current_app(self):
         _activityRE = re.compile(r'ACTIVITY (?P<package>[^/]+)/(?P<activity>[^/\s]+) \w+ pid=(?P<pid>\d+)')
-        m = _activityRE.search(adb.shell(serial=self.serial, port=self.port, sh=['dumpsys', 'activity', 'top']))
+        m = _activityRE.search(adb.shell(serial=self.serial, port=self.port, host=self.host, sh=['dumpsys', 'activity', 'top']))
         if m:
+            self._activity = m.group('package') + '/' + m.group('activity')
             return dict(package=m.group('package'), activity=m.group('activity'), pid=int(m.group('pid')))
 
         _focusedRE = re.compile('mFocusedApp=.*ActivityRecord{\w+ \w+ (?P<package>.*)/(?P<activity>.*) .*')
-        m = _focusedRE.search(adb.shell(serial=self.serial, port=self.port, sh=['dumpsys', 'window', 'windows']))
+        m = _focusedRE.search(adb.shell(serial=self.serial, port=self.port, host=self.host, sh=['dumpsys', 'window', 'windows']))
         if m:
+            self._activity = m.group('package') + '/' + m.group('activity')
             return dict(package=m.group('package'), activity=m.group('activity'))
         raise RuntimeError("Couldn't get focused app")
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+from __future__ import absolute_import
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tornado import gen
+
+from atx.drivers import Pattern
+from atx.drivers.android import ACTION_TIME, SETTLE_BUSY, SETTLE_INTERVAL, MATCH_THREADS, FlipSettle
+import atx.drivers.screen_mapping as mapping
+import atx.utils.adb as adb
+import atx.utils.images as images
+import atx.utils.texts as texts
+from atx.utils.adbasync import AsyncAdbClient
+from atx.utils.adbclient import AdbError
+
+_executor = None
+
+
+def match_executor():
+    """
+    threads shared by every AsyncApplication for decoding and matching, the IOLoop never blocks on opencv
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(MATCH_THREADS)
+    return _executor
+
+
+def _find(target, screen, memory):
+    # runs on the executor, reading a template and building its pyramid costs as much as the match
+    if isinstance(target, Pattern):
+        return images.find_hinted(target.template, screen, key=target.name,
+                                  roi=target.roi, threshold=target.threshold, memory=memory)
+    return images.find_hinted(target, screen, key=target, memory=memory)
+
+
+class AsyncApplication(object):
+    """
+    device primitives as coroutines, many devices on one IOLoop thread:
+
+        @gen.coroutine
+        def tap_image(app, target, timeout=15):
+            deadline = time.time() + timeout
+            while time.time() < deadline:
+                ret = yield app.find(target)
+                if ret is not None:
+                    yield app.tap(*mapping.computer(*ret.pos))
+                    raise gen.Return(ret)
+                yield gen.sleep(0.2)
+            raise ImageNotFoundError(target)
+
+        IOLoop.current().run_sync(lambda: gen.multi([tap_image(AsyncApplication(s), 'ok.png') for s in serials]))
+
+    this is a separate, smaller API, not the core of android.Application: no match
+    gate, engine selection, watchers, hooks or postmortem, and no polling helpers.
+    scripts written for Application keep running on it unchanged.
+
+    every adb call is a non-blocking smart-socket request, capture decoding,
+    template loading and matching run on match_executor().
+    """
+
+    def __init__(self, serial=None, port=None, host=None, executor=None):
+        self.serial = serial
+        self.port = port
+        self.host = host
+        self.display_id = None
+        self.client = AsyncAdbClient(host=host, port=port)
+        self.executor = executor or match_executor()
+        self.hits = images.HitMemory()
+        self.settle_timeout = 2.0
+        self.raw_capture = True
+        self._flips_supported = None
+
+    @gen.coroutine
+    def shell(self, *args):
+        output = yield self.client.shell(self.serial, " ".join(args))
+        raise gen.Return(output)
+
+    @gen.coroutine
+    def tap(self, x, y):
+        yield self.shell("input", "tap", str(x), str(y))
+        yield self.settle()
+
+    @gen.coroutine
+    def swipe(self, x1, y1, x2, y2):
+        yield self.shell("input", "swipe", str(x1), str(y1), str(x2), str(y2))
+        yield self.settle()
+
+    @gen.coroutine
+    def key_event(self, key):
+        yield self.shell("input", "keyevent", key)
+
+    @gen.coroutine
+    def back(self):
+        yield self.key_event("KEYCODE_BACK")
+        yield self.settle()
+
+    @gen.coroutine
+    def home(self):
+        yield self.key_event("KEYCODE_HOME")
+        yield self.settle()
+
+    @gen.coroutine
+    def type(self, msg):
+        if texts.is_ascii(msg):
+            yield self.shell("input", "text", texts.strip(msg))
+        else:
+            yield self.shell("input", "chinese", texts.strip(msg))
+
+    @gen.coroutine
+    def settle(self, timeout=None):
+        """
+        wait until SurfaceFlinger stops composing frames, the same decision as the auto
+        settle of android.Application; ACTION_TIME when the ROM can not tell
+
+        @return True when the UI went quiet, False when it gave up
+        """
+        start = time.time()
+        deadline = start + (self.settle_timeout if timeout is None else timeout)
+        if self._flips_supported is not False:
+            yield gen.sleep(SETTLE_INTERVAL)
+            count = adb.parse_flip_count((yield self.shell(*adb.FLIP_COUNT_CMD)))
+            self._flips_supported = count is not None
+            if count is not None:
+                settle = FlipSettle(count, deadline, SETTLE_BUSY)
+                while True:
+                    yield gen.sleep(SETTLE_INTERVAL)
+                    if settle.update(adb.parse_flip_count((yield self.shell(*adb.FLIP_COUNT_CMD)))):
+                        raise gen.Return(settle.quiet)
+        yield gen.sleep(max(0, min(ACTION_TIME - (time.time() - start), deadline - time.time())))
+        raise gen.Return(False)
+
+    @gen.coroutine
+    def screen_image(self):
+        """
+        @return opencv BGR image
+        """
+        cmd = "screencap" if self.display_id is None else "screencap -d %s" % self.display_id
+        if self.raw_capture:
+            data = yield self.client.exec_out(self.serial, cmd)
+            try:
+                image = yield self.executor.submit(images.from_raw, data, mapping.visible_area())
+                raise gen.Return(image)
+            except images.RawFormatError:
+                # screencap output the decoder does not know, keep the png path for this device
+                self.raw_capture = False
+        data = yield self.__screen_png(cmd.replace("screencap", "screencap -p", 1))
+        image = yield self.executor.submit(images.from_png, data, mapping.visible_area())
+        raise gen.Return(image)
+
+    @gen.coroutine
+    def __screen_png(self, cmd):
+        try:
+            data = yield self.client.exec_out(self.serial, cmd)
+        except AdbError:
+            # adbd without exec:, the pty of shell: turns \n into \r\n
+            data = yield self.client.service(self.serial, "shell:%s" % cmd)
+            data = data.replace(b'\r\n', b'\n')
+        raise gen.Return(data)
+
+    @gen.coroutine
+    def find(self, target, screen=None):
+        """
+        one match, not a wait: loop around it to poll
+
+        Args:
+            target: image path or Pattern
+            screen: match on this image instead of a new capture
+        @return images.MatchResult or None
+        """
+        if screen is None:
+            screen = yield self.screen_image()
+        ret = yield self.executor.submit(_find, target, screen, self.hits)
+        raise gen.Return(ret)
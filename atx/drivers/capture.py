@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import collections
+import os
+import threading
+import time
+import zipfile
+from io import BytesIO
+
+import cv2
+
+Frame = collections.namedtuple('Frame', ['image', 'timestamp', 'seq'])
+
+
+class FrameProducer(object):
+    """
+    keep grabbing frames in a background thread, so matching frame N overlaps
+    with transferring frame N+1
+
+    frames land in a double buffer: the slot being filled is never the one
+    handed out, readers always get a complete frame.
+    """
+
+    def __init__(self, grab, interval=0.0, name='frame-producer'):
+        """
+        Args:
+            grab: callable return one image
+            interval: seconds to rest between two grabs
+        """
+        self._grab = grab
+        self._interval = interval
+        self._name = name
+        self._slots = [None, None]
+        self._front = 0
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+        self.error = None
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(name=self._name, target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        with self._cond:
+            self._cond.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def latest(self):
+        with self._cond:
+            return self._slots[self._front]
+
+    def wait_newer(self, timestamp=0, timeout=None):
+        """
+        @return newest Frame captured after timestamp
+        @raise IOError when no such frame arrives within timeout
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while True:
+                frame = self._slots[self._front]
+                if frame is not None and frame.timestamp > timestamp:
+                    return frame
+                if not self._running:
+                    raise IOError("frame producer stopped")
+                remain = None if deadline is None else deadline - time.time()
+                if remain is not None and remain <= 0:
+                    raise IOError("no new frame in %ss: %s" % (timeout, self.error))
+                # wake up periodically so stop() and errors are noticed
+                self._cond.wait(0.5 if remain is None else min(remain, 0.5))
+
+    def _run(self):
+        while self._running:
+            start = time.time()
+            try:
+                image = self._grab()
+            except Exception as e:
+                self.error = e
+                time.sleep(max(self._interval, 0.2))
+                continue
+            self.error = None
+            with self._cond:
+                self._seq += 1
+                back = 1 - self._front
+                self._slots[back] = Frame(image, start, self._seq)
+                self._front = back
+                self._cond.notify_all()
+            if self._interval > 0:
+                time.sleep(self._interval)
+
+
+class FrameHistory(object):
+    """
+    bounded ring of recent frames, downscaled to keep memory small
+
+    Frame.image here is the downscaled copy, the budget is checked against
+    its nbytes so a stream of big frames can not grow without limit.
+    """
+
+    def __init__(self, max_frames=20, max_bytes=16 * 1024 * 1024, scale=0.25):
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.scale = scale
+        self._frames = collections.deque()
+        self._bytes = 0
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def append(self, image, timestamp=None):
+        if self.max_frames <= 0 or image is None:
+            return
+        if self.scale != 1:
+            image = cv2.resize(image, (0, 0), fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        with self._lock:
+            self._seq += 1
+            self._frames.append(Frame(image, timestamp or time.time(), self._seq))
+            self._bytes += image.nbytes
+            while self._frames and (len(self._frames) > self.max_frames or self._bytes > self.max_bytes):
+                self._bytes -= self._frames.popleft().image.nbytes
+
+    def frames(self):
+        with self._lock:
+            return list(self._frames)
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self._bytes = 0
+
+    def dump(self, save_dir, name='postmortem', count=None):
+        """
+        encode the last count frames and write them as one zip in a single write
+
+        @return path of the zip, None when there is nothing to dump
+        """
+        frames = self.frames()
+        if count is not None:
+            frames = frames[-count:]
+        if not frames:
+            return None
+        buf = BytesIO()
+        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED) as z:
+            for frame in frames:
+                ok, data = cv2.imencode('.jpg', frame.image)
+                if ok:
+                    stamp = time.strftime('%H%M%S', time.localtime(frame.timestamp))
+                    z.writestr('%04d_%s_%03d.jpg' % (frame.seq, stamp, int(frame.timestamp * 1000) % 1000),
+                               data.tobytes())
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+        path = os.path.join(save_dir, '%s_%d.zip' % (name, int(time.time() * 1000)))
+        with open(path, 'wb') as f:
+            f.write(buf.getvalue())
+        return path
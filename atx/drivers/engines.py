@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import collections
+import threading
+import time
+
+ENGINE_LOCAL = 'local'
+ENGINE_REMOTE = 'remote'
+# seconds recorded for a call the engine could not answer, a broken engine must not look cheap
+FAILURE_PENALTY = 5.0
+
+
+class RollingStats(object):
+    """
+    latency of the last `window` samples
+    """
+
+    def __init__(self, window=20):
+        self._samples = collections.deque(maxlen=window)
+        self.count = 0
+        self.last_time = 0
+
+    def add(self, seconds):
+        self._samples.append(seconds)
+        self.count += 1
+        self.last_time = time.time()
+
+    def __len__(self):
+        return len(self._samples)
+
+    @property
+    def mean(self):
+        if not self._samples:
+            return None
+        return sum(self._samples) / len(self._samples)
+
+    @property
+    def median(self):
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[len(ordered) // 2]
+
+    def to_dict(self):
+        return dict(samples=len(self._samples), total=self.count, mean=self.mean, median=self.median,
+                    last=self._samples[-1] if self._samples else None)
+
+
+class EngineSelector(object):
+    """
+    route every match to the engine with the lowest median latency
+
+    each enabled engine is sampled min_samples times first, afterwards every
+    explore_every-th call goes to the engine measured least recently so a
+    change of link or device load is noticed.
+    """
+
+    def __init__(self, engines=(ENGINE_LOCAL, ENGINE_REMOTE), window=20, min_samples=3, explore_every=25):
+        self.min_samples = min_samples
+        self.explore_every = explore_every
+        self._stats = collections.OrderedDict((name, RollingStats(window)) for name in engines)
+        self._enabled = set(engines)
+        self._calls = 0
+        self._current = None
+        self._lock = threading.Lock()
+
+    def enable(self, name, enabled=True):
+        with self._lock:
+            if enabled:
+                self._enabled.add(name)
+            else:
+                self._enabled.discard(name)
+
+    def enabled(self):
+        return [name for name in self._stats if name in self._enabled]
+
+    def choose(self):
+        with self._lock:
+            names = [name for name in self._stats if name in self._enabled]
+            if not names:
+                raise ValueError("no match engine enabled")
+            self._calls += 1
+            for name in names:
+                if len(self._stats[name]) < self.min_samples:
+                    return name
+            if len(names) > 1 and self._calls % self.explore_every == 0:
+                return min(names, key=lambda n: self._stats[n].last_time)
+            self._current = min(names, key=lambda n: self._stats[n].median)
+            return self._current
+
+    def record(self, name, seconds):
+        with self._lock:
+            self._stats[name].add(seconds)
+
+    def fail(self, name):
+        self.record(name, FAILURE_PENALTY)
+
+    @property
+    def current(self):
+        return self._current
+
+    def stats(self):
+        with self._lock:
+            engines = dict((name, s.to_dict()) for name, s in self._stats.items())
+            return dict(current=self._current, enabled=self.enabled(), engines=engines)
@@ -0,0 +1,489 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# device farm: an agent on every host with phones attached runs driver
+# primitives locally, a controller spreads jobs over the devices of all agents.
+#
+# every message: 'ATXF' json_length:u32 blob_length:u32 json blob, little-endian
+#
+# request  {"id": n, "method": "capture", "params": {...}}   blob: template png for match
+# response {"id": n, "result": ..., "error": null}          blob: encoded frame for capture
+#
+# an agent started with a token answers nothing but auth(token) until a
+# connection sent the same token, anything else closes the connection.
+#
+# methods: auth(token), devices, capture(serial, format, quality, scale), tap(serial, x, y),
+#          swipe(serial, x1, y1, x2, y2), key_event(serial, key),
+#          match(serial, template, threshold), template is the md5 of the png
+#
+
+from __future__ import absolute_import
+
+import hashlib
+import hmac
+import json
+import re
+import socket
+import struct
+import threading
+import time
+import traceback
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import cv2
+import numpy as np
+
+import atx.drivers.screen_mapping as mapping
+import atx.utils.adb as adb
+import atx.utils.images as images
+from atx.utils.images import ImageNotFoundError
+
+MAGIC = b'ATXF'
+HEADER = struct.Struct('<4sII')
+AGENT_PORT = 17320
+FORMATS = ('jpg', 'png')
+
+_key_re = re.compile(r'^\w+\Z')
+
+
+class FarmError(IOError):
+    pass
+
+
+class RemoteError(FarmError):
+    """
+    the agent is fine, the call failed on its side
+    """
+    pass
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 64 * 1024))
+        if not chunk:
+            raise FarmError("farm connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def send_message(sock, message, blob=b''):
+    body = json.dumps(message).encode('utf-8')
+    sock.sendall(HEADER.pack(MAGIC, len(body), len(blob)) + body + blob)
+
+
+def read_message(sock):
+    magic, length, blob_length = HEADER.unpack(_recv_exactly(sock, HEADER.size))
+    if magic != MAGIC:
+        raise FarmError("bad magic %r" % magic)
+    message = json.loads(_recv_exactly(sock, length).decode('utf-8'))
+    return message, _recv_exactly(sock, blob_length)
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        authorized = self.server.token is None
+        while True:
+            try:
+                message, blob = read_message(self.request)
+            except (socket.error, FarmError, ValueError):
+                return
+            if message.get('method') == 'auth' or not authorized:
+                authorized = self.server.check_token((message.get('params') or {}).get('token'))
+                send_message(self.request, dict(id=message.get('id'), result=authorized,
+                                                error=None if authorized else 'not authorized'))
+                if not authorized:
+                    return
+                continue
+            result, out_blob, error = None, b'', None
+            try:
+                result, out_blob = self.server.dispatch(message.get('method'), message.get('params') or {}, blob)
+            except Exception as e:
+                error = '%s: %s' % (type(e).__name__, e)
+                traceback.print_exc()
+            send_message(self.request, dict(id=message.get('id'), result=result, error=error), out_blob)
+
+
+class FarmAgent(socketserver.ThreadingTCPServer):
+    """
+    serve the devices attached to this host
+
+    Args:
+        address: (ip, port) to listen on, loopback only by default
+        host, port: the local adb server
+        app_factory: callable(serial) return an android.Application-like object
+        token: shared secret a controller has to send first, None accepts every connection
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', AGENT_PORT), host=None, port=None, app_factory=None, token=None):
+        socketserver.ThreadingTCPServer.__init__(self, address, _Handler)
+        self.adb_host = host
+        self.adb_port = port
+        self.token = token
+        self.app_factory = app_factory or self.__new_app
+        self.templates = {}
+        self._apps = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(name='farm-agent', target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        with self._lock:
+            apps, self._apps = list(self._apps.values()), {}
+        for app in apps:
+            try:
+                app.close()
+            except IOError:
+                pass
+
+    def app(self, serial):
+        with self._lock:
+            app = self._apps.get(serial)
+            if app is None:
+                app = self._apps[serial] = self.app_factory(serial)
+            return app
+
+    def check_token(self, token):
+        if self.token is None:
+            return True
+        if token is None:
+            return False
+        a, b = (u'%s' % v for v in (token, self.token))
+        return hmac.compare_digest(a.encode('utf-8'), b.encode('utf-8'))
+
+    def list_devices(self):
+        """
+        @return list of (serial, state) of the local adb server
+        """
+        return adb.client(host=self.adb_host, port=self.adb_port).devices()
+
+    def dispatch(self, method, params, blob):
+        """
+        @return (result, blob)
+        """
+        if method == 'devices':
+            return [dict(serial=serial, state=state) for serial, state in self.list_devices()], b''
+        serial = params.get('serial')
+        if method == 'capture':
+            image = self.app(serial).screen_frame()
+            scale = float(params.get('scale', 1.0))
+            if scale != 1.0:
+                image = cv2.resize(image, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            fmt = params.get('format', 'jpg')
+            if fmt not in FORMATS:
+                raise ValueError("unknown format %r" % fmt)
+            flags = [cv2.IMWRITE_JPEG_QUALITY, int(params.get('quality', 80))] if fmt == 'jpg' else []
+            ok, data = cv2.imencode('.' + fmt, image, flags)
+            if not ok:
+                raise IOError("encode %s failed" % fmt)
+            h, w = image.shape[:2]
+            return dict(width=w, height=h, format=fmt), data.tobytes()
+        # parameters end up on the device shell command line, only plain numbers and keycodes get there
+        if method == 'tap':
+            self.app(serial).tap(int(params['x']), int(params['y']))
+            return None, b''
+        if method == 'swipe':
+            self.app(serial).swipe(int(params['x1']), int(params['y1']), int(params['x2']), int(params['y2']))
+            return None, b''
+        if method == 'key_event':
+            key = str(params['key'])
+            if not _key_re.match(key):
+                raise ValueError("bad key %r" % key)
+            adb.key_event(serial=serial, port=self.adb_port, host=self.adb_host, key=key)
+            return None, b''
+        if method == 'match':
+            digest = params['template']
+            if blob:
+                image = cv2.imdecode(np.frombuffer(blob, dtype=np.uint8), cv2.IMREAD_COLOR)
+                if image is None:
+                    raise IOError("template %s is not an image" % digest)
+                self.templates[digest] = images.make_template(image)
+            if digest not in self.templates:
+                raise KeyError("unknown template %s" % digest)
+            ret = images.find(self.templates[digest], self.app(serial).screen_frame(),
+                              threshold=params.get('threshold'))
+            if ret is None:
+                return dict(found=False), b''
+            x, y = mapping.computer(*ret.pos)
+            return dict(found=True, pos=(int(x), int(y)), confidence=float(ret.confidence)), b''
+        raise ValueError("unknown method %s" % method)
+
+    def __new_app(self, serial):
+        from atx.drivers.android import Application
+        app = Application(serial=serial, port=self.adb_port, host=self.adb_host)
+        app.prepare()
+        return app
+
+
+class FarmClient(object):
+    """
+    one connection to an agent, calls are serialized
+    """
+
+    def __init__(self, host, port=AGENT_PORT, timeout=30, token=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.token = token
+        self.sent_templates = set()
+        self._sock = None
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def connect(self):
+        if self._sock is None:
+            try:
+                self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            except socket.error as e:
+                raise FarmError("agent %s:%d not reachable: %s" % (self.host, self.port, e))
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # a new connection may reach a restarted agent without our templates
+            self.sent_templates = set()
+            if self.token is not None:
+                self.__auth()
+        return self
+
+    def __auth(self):
+        try:
+            send_message(self._sock, dict(id=0, method='auth', params=dict(token=self.token)))
+            message, _ = read_message(self._sock)
+        except (socket.error, FarmError, ValueError) as e:
+            self.close()
+            raise FarmError("auth on %s:%d: %s" % (self.host, self.port, e))
+        if not message.get('result'):
+            self.close()
+            raise FarmError("agent %s:%d refused the token" % (self.host, self.port))
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def call(self, method, blob=b'', **params):
+        """
+        @return (result, blob)
+        @raise FarmError on transport errors, RemoteError for errors raised by the agent
+        """
+        with self._lock:
+            self._seq += 1
+            try:
+                self.connect()
+                send_message(self._sock, dict(id=self._seq, method=method, params=params), blob)
+                message, out_blob = read_message(self._sock)
+            except (socket.error, FarmError, ValueError) as e:
+                self.close()
+                raise FarmError("%s on %s:%d: %s" % (method, self.host, self.port, e))
+            if message.get('id') != self._seq:
+                self.close()
+                raise FarmError("response %s for request %d" % (message.get('id'), self._seq))
+            if message.get('error'):
+                raise RemoteError(message['error'])
+            return message.get('result'), out_blob
+
+    def devices(self):
+        return self.call('devices')[0]
+
+
+class RemoteDevice(object):
+    """
+    driver primitives of one device, executed by the agent it is attached to
+    """
+
+    def __init__(self, client, serial):
+        self.client = client
+        self.serial = serial
+
+    def __repr__(self):
+        return 'RemoteDevice(%s@%s:%d)' % (self.serial, self.client.host, self.client.port)
+
+    def screen_image(self, format='jpg', quality=80, scale=1.0):
+        """
+        @return opencv BGR image, jpg frames are lossy, use format='png' to match on them
+        """
+        _, data = self.client.call('capture', serial=self.serial, format=format, quality=quality, scale=scale)
+        return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    def tap(self, x, y):
+        self.client.call('tap', serial=self.serial, x=x, y=y)
+
+    def swipe(self, x1, y1, x2, y2):
+        self.client.call('swipe', serial=self.serial, x1=x1, y1=y1, x2=x2, y2=y2)
+
+    def key_event(self, key):
+        self.client.call('key_event', serial=self.serial, key=key)
+
+    def match(self, local_object_path, threshold=None):
+        """
+        capture and match on the agent, the template travels once per connection
+
+        @return (pos, confidence) or None
+        """
+        with open(local_object_path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.md5(data).hexdigest()
+        blob = b'' if digest in self.client.sent_templates else data
+        result, _ = self.client.call('match', blob, serial=self.serial, template=digest, threshold=threshold)
+        self.client.sent_templates.add(digest)
+        if not result['found']:
+            return None
+        return tuple(result['pos']), result['confidence']
+
+    def exists(self, local_object_path):
+        return self.match(local_object_path) is not None
+
+    def tap_image(self, local_object_path, timeout=15, frequency=0.2):
+        start_time = time.time()
+        while time.time() - start_time < timeout:
+            ret = self.match(local_object_path)
+            if ret is not None:
+                x, y = ret[0]
+                self.tap(x, y)
+                return x, y
+            time.sleep(frequency)
+        raise ImageNotFoundError('Not found image %s' % local_object_path)
+
+
+class JobResult(object):
+    def __init__(self, index, device, value=None, error=None, duration=0.0):
+        self.index = index
+        self.device = device
+        self.value = value
+        self.error = error
+        self.duration = duration
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return 'JobResult(%d, %s, %s)' % (self.index, self.device, 'ok' if self.ok else self.error)
+
+
+class FarmController(object):
+    """
+    run jobs on every online device of every agent, a device takes the next job when free
+
+        farm = FarmController(['10.0.0.2:17320', '10.0.0.3:17320'])
+        results = farm.run([lambda d: d.tap_image('start.png'), ...])
+
+    a job is callable(RemoteDevice). a job whose agent drops the connection is
+    handed to another device once, the device is not used again in this run.
+    token is the shared secret the agents were started with.
+    """
+
+    def __init__(self, agents, timeout=30, token=None):
+        self.agents = [_address(agent) for agent in agents]
+        self.timeout = timeout
+        self.token = token
+
+    def devices(self):
+        """
+        @return RemoteDevice for every online device, each with its own connection
+        """
+        devices = []
+        for host, port in self.agents:
+            try:
+                listed = FarmClient(host, port, self.timeout, self.token).devices()
+            except FarmError as e:
+                print("Warning: agent %s:%d skipped, Error %s" % (host, port, e))
+                continue
+            for d in listed:
+                if d['state'] == 'device':
+                    devices.append(RemoteDevice(FarmClient(host, port, self.timeout, self.token), d['serial']))
+        return devices
+
+    def run(self, jobs, devices=None, retries=1):
+        """
+        @return list of JobResult in job order
+        """
+        devices = devices or self.devices()
+        if not devices:
+            raise FarmError("no device online in the farm")
+        pending = queue.Queue()
+        for index, job in enumerate(jobs):
+            pending.put((index, job, 0))
+        results = [None] * len(jobs)
+        lock = threading.Lock()
+        alive = [len(devices)]
+        # jobs without a result yet, a worker stays until it drops to 0: a job handed
+        # back by a device that went away may still show up in the queue
+        outstanding = [len(jobs)]
+
+        def _done(index, result):
+            results[index] = result
+            with lock:
+                outstanding[0] -= 1
+
+        def _worker(device):
+            while True:
+                with lock:
+                    if outstanding[0] == 0:
+                        return
+                try:
+                    index, job, tries = pending.get(True, 0.1)
+                except queue.Empty:
+                    continue
+                start = time.time()
+                try:
+                    value = job(device)
+                except RemoteError as e:
+                    _done(index, JobResult(index, device, error=e, duration=time.time() - start))
+                except FarmError as e:
+                    with lock:
+                        alive[0] -= 1
+                        last = alive[0] == 0
+                    if tries < retries and not last:
+                        pending.put((index, job, tries + 1))
+                    else:
+                        _done(index, JobResult(index, device, error=e, duration=time.time() - start))
+                    # the agent or the link is gone, leave the rest to the other devices
+                    return
+                except Exception as e:
+                    _done(index, JobResult(index, device, error=e, duration=time.time() - start))
+                else:
+                    _done(index, JobResult(index, device, value=value, duration=time.time() - start))
+
+        threads = [threading.Thread(name='farm-%s' % d.serial, target=_worker, args=(d,)) for d in devices]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        for index in range(len(jobs)):
+            if results[index] is None:
+                results[index] = JobResult(index, None, error=FarmError("no device left"))
+        for d in devices:
+            d.client.close()
+        return results
+
+
+def _address(agent):
+    if isinstance(agent, (tuple, list)):
+        return agent[0], int(agent[1])
+    host, _, port = agent.rpartition(':')
+    return (host, int(port)) if host else (agent, AGENT_PORT)
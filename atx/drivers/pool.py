@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import collections
+import fcntl
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+
+import atx.utils.adb as adb
+
+# a device going unhealthy this many times within QUARANTINE_WINDOW is benched for QUARANTINE_TIME
+QUARANTINE_FLAPS = 3
+QUARANTINE_WINDOW = 300
+QUARANTINE_TIME = 600
+RECONNECT_BACKOFF = (1, 60)
+
+
+class NoDeviceError(IOError):
+    pass
+
+
+class DeviceLease(object):
+    """
+    exclusive use of one device until release(), also across processes
+
+        with pool.acquire() as lease:
+            lease.app.tap(100, 200)
+    """
+
+    def __init__(self, pool, serial, lock_file):
+        self.pool = pool
+        self.serial = serial
+        self._lock_file = lock_file
+        self._app = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    @property
+    def active(self):
+        return self._lock_file is not None
+
+    @property
+    def app(self):
+        """
+        prepared android.Application for the leased device, created on first use
+        """
+        if not self.active:
+            raise NoDeviceError("lease of %s already released" % self.serial)
+        if self._app is None:
+            from atx.drivers.android import Application
+            self._app = Application(serial=self.serial, port=self.pool.port, host=self.pool.host)
+            self._app.prepare()
+        return self._app
+
+    def release(self):
+        if self._app is not None:
+            try:
+                self._app.close()
+            except IOError:
+                pass
+            self._app = None
+        if self._lock_file is not None:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
+
+
+class _Health(object):
+    def __init__(self):
+        self.healthy = None
+        self.last_check = 0
+        self.flaps = collections.deque()
+        self.reconnect_at = 0
+        self.backoff = RECONNECT_BACKOFF[0]
+
+
+class DevicePool(object):
+    """
+    lease devices to scripts, one holder per device at a time
+
+    a lease is an flock on <lock_dir>/<serial>.lock, the kernel drops it when
+    the holder dies, so a crashed script never leaves a device locked.
+    health is checked with get-state plus a shell echo, in background once
+    start() is called. network devices (ip:port) adb no longer reports as
+    'device' are `adb connect`ed again with exponential backoff; one that only
+    fails the echo keeps its transport. a device that keeps flapping is
+    quarantined for all processes through <lock_dir>/<serial>.quarantine.
+
+    Args:
+        serials: devices to manage, every device adb knows by default
+    """
+
+    def __init__(self, serials=None, host=None, port=None, lock_dir=None, check_interval=10):
+        self.serials = list(serials) if serials else None
+        self.host = host
+        self.port = port
+        self.lock_dir = lock_dir or os.path.join(tempfile.gettempdir(), 'atx-leases')
+        self.check_interval = check_interval
+        self._health = collections.defaultdict(_Health)
+        self._mutex = threading.Lock()
+        self._thread = None
+        self._running = False
+        if not os.path.exists(self.lock_dir):
+            try:
+                os.makedirs(self.lock_dir)
+            except OSError:
+                # another process created it first
+                pass
+
+    def devices(self):
+        if self.serials is not None:
+            return list(self.serials)
+        try:
+            return [serial for serial, _ in adb.client(host=self.host, port=self.port).devices()]
+        except (IOError, socket.error):
+            return []
+
+    def acquire(self, serial=None, timeout=None, interval=0.5):
+        """
+        lease serial, or any healthy device when serial is None
+
+        @return DeviceLease
+        @raise NoDeviceError when nothing could be leased within timeout
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            candidates = [serial] if serial else self.devices()
+            for candidate in candidates:
+                if self.quarantined(candidate):
+                    continue
+                lock_file = self.__try_lock(candidate)
+                if lock_file is None:
+                    continue
+                if self.check(candidate):
+                    return DeviceLease(self, candidate, lock_file)
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+            if deadline is not None and time.time() >= deadline:
+                raise NoDeviceError("no device available in %ss: %s" % (timeout, serial or 'any'))
+            time.sleep(interval)
+
+    def check(self, serial):
+        """
+        @return True when the device answers, reconnects network devices adb lost
+        """
+        state = self.__state(serial)
+        ok = state == 'device' and self.__echo(serial)
+        # a busy device that is slow to echo keeps its transport, another process may be using it
+        if state != 'device' and ':' in serial:
+            ok = self.__reconnect(serial)
+        self.__record(serial, ok)
+        return ok
+
+    def quarantined(self, serial):
+        path = self.__path(serial, '.quarantine')
+        try:
+            with open(path) as f:
+                until = float(f.read().strip() or 0)
+        except (IOError, OSError, ValueError):
+            return False
+        if until > time.time():
+            return True
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return False
+
+    def release_quarantine(self, serial):
+        try:
+            os.remove(self.__path(serial, '.quarantine'))
+        except OSError:
+            pass
+
+    def status(self):
+        """
+        @return dict serial -> dict(healthy, quarantined, flaps) as seen by this process
+        """
+        with self._mutex:
+            return dict((serial, dict(healthy=self._health[serial].healthy,
+                                      quarantined=self.quarantined(serial),
+                                      flaps=len(self._health[serial].flaps)))
+                        for serial in self.devices())
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(name='device-pool', target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while self._running:
+            for serial in self.devices():
+                if not self._running:
+                    break
+                if time.time() - self._health[serial].last_check >= self.check_interval:
+                    self.check(serial)
+            time.sleep(min(1.0, self.check_interval))
+
+    def __state(self, serial):
+        try:
+            return adb.client(host=self.host, port=self.port).get_state(serial).strip()
+        except (IOError, socket.error):
+            return None
+
+    def __echo(self, serial):
+        try:
+            output = adb.shell(serial=serial, port=self.port, host=self.host, sh=["echo", "ATX_OK"],
+                               timeout=adb.PROBE_TIMEOUT)
+            return 'ATX_OK' in output
+        except (IOError, socket.error):
+            return False
+
+    def __reconnect(self, serial):
+        health = self._health[serial]
+        now = time.time()
+        if now < health.reconnect_at:
+            return False
+        try:
+            adb.disconnect(serial=serial, port=self.port, host=self.host)
+            adb.connect(serial=serial, port=self.port, host=self.host)
+        except (IOError, socket.error):
+            pass
+        if self.__state(serial) == 'device' and self.__echo(serial):
+            health.backoff = RECONNECT_BACKOFF[0]
+            return True
+        health.reconnect_at = now + health.backoff
+        health.backoff = min(health.backoff * 2, RECONNECT_BACKOFF[1])
+        return False
+
+    def __record(self, serial, ok):
+        with self._mutex:
+            health = self._health[serial]
+            now = time.time()
+            if health.healthy and not ok:
+                health.flaps.append(now)
+            while health.flaps and now - health.flaps[0] > QUARANTINE_WINDOW:
+                health.flaps.popleft()
+            health.healthy = ok
+            health.last_check = now
+            flapping = len(health.flaps) >= QUARANTINE_FLAPS
+            if flapping:
+                health.flaps.clear()
+        if flapping:
+            with open(self.__path(serial, '.quarantine'), 'w') as f:
+                f.write('%f' % (now + QUARANTINE_TIME))
+
+    def __try_lock(self, serial):
+        lock_file = open(self.__path(serial, '.lock'), 'a+')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock_file.close()
+            return None
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write('%d\n' % os.getpid())
+        lock_file.flush()
+        return lock_file
+
+    def __path(self, serial, ext):
+        return os.path.join(self.lock_dir, re.sub(r'[^\w.-]+', '_', serial) + ext)
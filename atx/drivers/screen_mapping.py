@@ -75,13 +75,16 @@ def computer_match(cv):
     match_x = 0
     match_y = 0
     count = 0
-    visible_left, visible_top, _, _ = visible_area()
     for point in points:
         if len(point) > 0:
             x, y = point.split(",")
             match_x = match_x + int(x)
             match_y = match_y + int(y)
             count = count + 1
-    match_x = match_x / count - visible_left
-    match_y = match_y / count - visible_top
-    return computer(x=match_x, y=match_y)
+    return from_screen(x=match_x / count, y=match_y / count)
+
+
+def from_screen(x=0, y=0):
+    """full screen pixel to the coordinate taps use"""
+    visible_left, visible_top, _, _ = visible_area() or (0, 0, 0, 0)
+    return computer(x=x - visible_left, y=y - visible_top)
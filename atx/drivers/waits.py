@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import collections
+import itertools
+import xml.etree.ElementTree as ET
+
+WaitResult = collections.namedtuple('WaitResult', ['index', 'condition', 'value'])
+
+_MISSING = object()
+
+
+class Backoff(object):
+    """
+    poll delays growing from initial by factor up to maximum
+
+    any iterable of seconds works as a schedule too, its last value is repeated
+    """
+
+    def __init__(self, initial=0.1, factor=1.5, maximum=1.0):
+        self.initial = initial
+        self.factor = factor
+        self.maximum = maximum
+
+    def __iter__(self):
+        delay = self.initial
+        while True:
+            yield min(delay, self.maximum)
+            delay *= self.factor
+
+
+def schedule(backoff):
+    """
+    @return endless iterator of delays from a Backoff, a number or a list of seconds
+    """
+    if backoff is None:
+        return iter(Backoff())
+    if isinstance(backoff, (int, float)):
+        return itertools.repeat(backoff)
+    if isinstance(backoff, Backoff):
+        return iter(backoff)
+    delays = list(backoff)
+    return itertools.chain(delays, itertools.repeat(delays[-1]))
+
+
+class Tick(object):
+    """
+    everything the conditions of one poll look at, each source is read at most once
+
+    Args:
+        positions: dict target -> tap position or None, filled by one capture
+        screen: callable return the BGR frame of this tick
+        activity: callable return the top activity
+        ui: callable return the uiautomator xml of the current window
+    """
+
+    def __init__(self, positions, screen, activity, ui):
+        self.positions = positions
+        self._sources = dict(screen=screen, activity=activity, ui=ui)
+        self._values = {}
+
+    def __get(self, name):
+        value = self._values.get(name, _MISSING)
+        if value is _MISSING:
+            value = self._values[name] = self._sources[name]()
+        return value
+
+    @property
+    def screen(self):
+        return self.__get('screen')
+
+    @property
+    def activity(self):
+        return self.__get('activity')
+
+    @property
+    def ui(self):
+        return self.__get('ui')
+
+    @property
+    def ui_tree(self):
+        """
+        parsed ui, None when the dump is empty or broken
+        """
+        tree = self._values.get('ui_tree', _MISSING)
+        if tree is _MISSING:
+            tree = None
+            if self.ui:
+                try:
+                    tree = ET.fromstring(self.ui.encode('utf-8'))
+                except ET.ParseError:
+                    pass
+            self._values['ui_tree'] = tree
+        return tree
+
+    def position(self, target):
+        return self.positions.get(target)
+
+
+class Condition(object):
+    """
+    evaluate() returns the value the wait hands back, None or False when not met yet
+    """
+    targets = ()
+
+    def evaluate(self, tick):
+        raise NotImplementedError
+
+
+class ImageExists(Condition):
+    def __init__(self, target):
+        self.target = target
+        self.targets = (target,)
+
+    def evaluate(self, tick):
+        return tick.position(self.target)
+
+    def __repr__(self):
+        return 'ImageExists(%s)' % self.target
+
+
+class ImageGone(Condition):
+    def __init__(self, target):
+        self.target = target
+        self.targets = (target,)
+
+    def evaluate(self, tick):
+        return tick.position(self.target) is None
+
+    def __repr__(self):
+        return 'ImageGone(%s)' % self.target
+
+
+class ActivityIs(Condition):
+    """
+    activity is 'package/.Activity' as returned by Application.current_activity
+    """
+
+    def __init__(self, activity):
+        self.activity = activity
+
+    def evaluate(self, tick):
+        return tick.activity if tick.activity == self.activity else None
+
+    def __repr__(self):
+        return 'ActivityIs(%s)' % self.activity
+
+
+class TextExists(Condition):
+    """
+    a node of the window whose text or content-desc equals text (contains it when partial)
+
+    the value is the tap position of the node center
+    """
+
+    def __init__(self, text, partial=False):
+        self.text = text
+        self.partial = partial
+
+    def evaluate(self, tick):
+        root = tick.ui_tree
+        if root is None:
+            return None
+        for node in root.iter('node'):
+            for attr in ('text', 'content-desc'):
+                value = node.get(attr) or ''
+                if value == self.text or (self.partial and self.text in value):
+                    return _bounds_center(node.get('bounds'))
+        return None
+
+    def __repr__(self):
+        return 'TextExists(%s)' % self.text
+
+
+class Predicate(Condition):
+    """
+    fn(tick) decides, it can read tick.screen, tick.activity and tick.ui_tree without extra captures
+    """
+
+    def __init__(self, fn, name=None):
+        self.fn = fn
+        self.name = name or getattr(fn, '__name__', 'predicate')
+
+    def evaluate(self, tick):
+        return self.fn(tick)
+
+    def __repr__(self):
+        return 'Predicate(%s)' % self.name
+
+
+def _bounds_center(bounds):
+    # bounds="[0,72][1080,200]"
+    try:
+        left, top, right, bottom = [int(v) for v in bounds.replace('][', ',').strip('[]').split(',')]
+    except (AttributeError, ValueError):
+        return True
+    return (left + right) // 2, (top + bottom) // 2
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import collections
+import threading
+import time
+import traceback
+
+from atx.errors import WatchTimeoutError
+
+
+class InputLock(object):
+    """
+    reentrant lock around everything that touches the device input, remembers
+    when the last input finished so a frame older than it is known to be stale
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.last_input = 0
+
+    def __enter__(self):
+        self._lock.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self._lock.release()
+
+    def touch(self):
+        self.last_input = time.time()
+
+
+class Watcher(object):
+    """
+    Args:
+        target: image path or Pattern
+        action: callable(pos) run when target is found, tap on it by default
+        interval: seconds between two checks of this watcher
+    """
+
+    def __init__(self, name, target, action=None, interval=1.0):
+        self.name = name
+        self.target = target
+        self.action = action
+        self.interval = interval
+        self.last_check = 0
+        self.count = 0
+        self.last_pos = None
+        self._fired = threading.Event()
+
+    def due(self, now):
+        return now - self.last_check >= self.interval
+
+    def wait(self, timeout=15):
+        """
+        block until the watcher fired at least once
+
+        @raise WatchTimeoutError
+        """
+        if not self._fired.wait(timeout):
+            raise WatchTimeoutError("watcher %s not triggered in %ss" % (self.name, timeout))
+        return self.last_pos
+
+    def __repr__(self):
+        return 'Watcher(%s, %s)' % (self.name, self.target)
+
+
+class WatcherRegistry(object):
+    """
+    check the registered watchers in a background thread, on frames somebody
+    else already captured, so watching never costs an extra screencap
+
+    a watcher matches and acts while holding the input lock, the script can
+    not send input in between. frames older than the last input are skipped.
+
+    Args:
+        frames: callable return the newest Frame or None
+        locate: callable(target, image) return tap position or None
+        act: callable(pos) used for watchers without action
+        lock: InputLock shared with the script
+    """
+
+    def __init__(self, frames, locate, act, lock, poll=0.1, name='watcher'):
+        self._frames = frames
+        self._locate = locate
+        self._act = act
+        self.lock = lock
+        self.poll = poll
+        self.error = None
+        self._name = name
+        self._watchers = collections.OrderedDict()
+        self._mutex = threading.Lock()
+        self._thread = None
+        self._running = False
+
+    def add(self, watcher):
+        with self._mutex:
+            self._watchers[watcher.name] = watcher
+        return watcher
+
+    def remove(self, name):
+        with self._mutex:
+            return self._watchers.pop(name, None)
+
+    def get(self, name):
+        with self._mutex:
+            return self._watchers.get(name)
+
+    def names(self):
+        with self._mutex:
+            return list(self._watchers)
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(name=self._name, target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def check(self, frame):
+        """
+        run every due watcher against frame
+
+        @return list of watchers that fired
+        """
+        fired = []
+        now = time.time()
+        with self._mutex:
+            watchers = [w for w in self._watchers.values() if w.due(now)]
+        for watcher in watchers:
+            with self.lock:
+                if frame.timestamp < self.lock.last_input:
+                    break
+                watcher.last_check = now
+                pos = self._locate(watcher.target, frame.image)
+                if pos is None:
+                    continue
+                (watcher.action or self._act)(pos)
+                self.lock.touch()
+            watcher.count += 1
+            watcher.last_pos = pos
+            watcher._fired.set()
+            fired.append(watcher)
+            # the screen is different after an action, the rest waits for the next frame
+            break
+        return fired
+
+    def _run(self):
+        last = 0
+        while self._running:
+            frame = self._frames()
+            if frame is not None and frame.timestamp > last:
+                last = frame.timestamp
+                try:
+                    self.check(frame)
+                    self.error = None
+                except Exception as e:
+                    self.error = e
+                    traceback.print_exc()
+            time.sleep(self.poll)
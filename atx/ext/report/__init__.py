@@ -15,6 +15,7 @@ from atx import imutils
 from atx.base import nameddict
 from atx.ext.report import patch as pt
 import shutil
+import cv2
 import numpy
 from PIL.Image import Image
 import atx.drivers.screen_mapping as mapping
@@ -32,6 +33,8 @@ LEVEL_DEFAULT = 1 << 0
 LEVEL_HTML = 1 << 1
 LEVEL_STACK = 1 << 2
 
+LAST_FRAME_AGE = 1.0
+
 __dir__ = os.path.dirname(os.path.abspath(__file__))
 
 
@@ -138,13 +141,13 @@ class Reporter(object):
     def __image_saver(self, name='', image=None):
         path = "%s/%s%s.png" % (self.image_path, name, time.time())
         if image is None:
-            self.app.screen_image().save(path)
+            cv2.imwrite(path, self.app.screen_frame())
         elif isinstance(image, str) or isinstance(image, unicode):
             shutil.copyfile(image, path)
         elif isinstance(image, Image):
             image.save(path)
         elif isinstance(image, numpy.ndarray):
-            imutils.to_pillow(image).save(path)
+            cv2.imwrite(path, image)
         return path.replace(self.path + '/', '')
 
     def __enable_html(self):
@@ -157,20 +160,41 @@ class Reporter(object):
         before = dict()
         before['start'] = time.time()
         if self.__enable_html():
-            before['bf_screen'] = self.app.screen_image()
+            # reuse the frame the driver captured moments ago instead of taking one more screenshot
+            frame = self.app.last_frame(max_age=LAST_FRAME_AGE)
+            input_lock = getattr(self.app, 'input_lock', None)
+            if frame is not None and input_lock is not None and frame.timestamp < input_lock.last_input:
+                # captured before an earlier input, the screen has changed since
+                frame = None
+            before['bf_screen'] = self.app.screen_frame() if frame is None else frame.image
         if self.__enable_stack():
             before['bf_activity'] = self.app.current_activity()
         self.cache[hook.tag] = before
 
+    def __after_screen(self, start):
+        """
+        the screen after the action: the frame the driver captured since the last input
+        (settle, polling, screenshot) or the next one the producer delivers
+        """
+        input_lock = getattr(self.app, 'input_lock', None)
+        newer_than = max(start, 0 if input_lock is None else input_lock.last_input)
+        frame = self.app.last_frame()
+        if frame is None or frame.timestamp < newer_than:
+            # nothing fresh yet, grab_frame() only captures when no producer is running
+            frame = self.app.grab_frame(newer_than=newer_than)
+        return frame.image
+
     def __trigger_after(self, hook):
         after = self.cache.pop(hook.tag) if hook.tag in self.cache else dict()
         after['success'] = hook.traceback is None
         after['traceback'] = None if hook.traceback is None else hook.traceback.stack
         after['action'] = self.__action_from_flag(hook.flag)
+        if hook.traceback is not None:
+            after['postmortem'] = getattr(hook.traceback.exception, 'postmortem', None)
         if self.__enable_html():
             target = None if 'local_object_path' not in hook.kwargs else hook.kwargs["local_object_path"]
             last = None if 'bf_screen' not in after else after.pop('bf_screen')
-            current = self.app.screen_image()
+            current = self.__after_screen(after.get('start', 0))
             if hook.flag == consts.EVENT_CLICK:
                 x, y = hook.args
                 x, y = mapping.revise_computer(x, y)
@@ -77,20 +77,16 @@ def open_as_pillow(filename):
 
 
 def from_pillow(pil_image):
-    """ Convert from pillow image to opencv """
-    # convert PIL to OpenCV
-    pil_image = pil_image.convert('RGB')
-    cv2_image = np.array(pil_image)
-    # Convert RGB to BGR 
-    cv2_image = cv2_image[:, :, ::-1].copy()
-    return cv2_image
+    """ Convert from pillow image to opencv, opencv images pass through untouched """
+    if isinstance(pil_image, np.ndarray):
+        return pil_image
+    rgb = np.asarray(pil_image.convert('RGB'))
+    return cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
 
 
 def to_pillow(image):
-    return Image.fromarray(image[:, :, ::-1].copy())
-    # There is another way
-    # img_bytes = cv2.imencode('.png', image)[1].tostring()
-    # return Image.open(BytesIO(img_bytes))
+    """ Convert from opencv image to pillow with a single BGR -> RGB copy """
+    return Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
 
 def url_to_image(url, flag=cv2.IMREAD_COLOR):
     """ download the image, convert it to a NumPy array, and then read
@@ -134,6 +130,25 @@ def diff_rect(img1, img2, pos=None):
         if x0 <= x <= x1 and y0 <= y <= y1:
             return (x0, y0, x1, y1)
 
+def thumbnail(img, size=(64, 36)):
+    """small gray copy of a BGR image, cheap to keep around and compare"""
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+def diff_ratio(img1, img2, size=(64, 36), threshold=16):
+    """
+    fraction of pixels that changed between two frames, compared on a small gray thumbnail
+
+    Args:
+        - size: thumbnail (width, height), hides noise and keeps it cheap
+        - threshold: gray level difference that counts as changed
+    """
+    if img1 is None or img2 is None or img1.shape != img2.shape:
+        return 1.0
+    changed = cv2.absdiff(thumbnail(img1, size), thumbnail(img2, size)) > threshold
+    return float(np.count_nonzero(changed)) / changed.size
+
 def mark_point(img, x, y):
     """
     Mark a point
@@ -3,8 +3,12 @@
 
 __author__ = 'Yeshen'
 
+import re
+import socket
+
 from atx.utils import time_log
 import atx.utils.texts as texts
+import atx.utils.adbclient as adbclient
 
 try:
     import subprocess32 as subprocess
@@ -12,6 +16,17 @@ except:
     import subprocess
 
 
+USE_SOCKET = True
+USE_SESSION = True
+# seconds a quick probe may take in a session, other commands wait until they finish
+PROBE_TIMEOUT = 10
+
+_sessions = {}
+
+# SurfaceFlinger page flip counter transaction
+FLIP_COUNT_CMD = ["service", "call", "SurfaceFlinger", "1013"]
+
+
 def __adb_path():
     return "adb"
 
@@ -24,12 +39,59 @@ def __adb_port():
     return "5037"
 
 
+def client(host=None, port=None):
+    return adbclient.AdbClient(host=host or __adb_host(), port=port or __adb_port())
+
+
 def run(serial=None, port=5037, cmd=list(), host=None, stdout=None, stderr=None):
+    if USE_SOCKET and stdout is None and stderr is None:
+        try:
+            return __run_socket(serial=serial, port=port, cmd=cmd, host=host)
+        except NotImplementedError:
+            pass
+        except adbclient.ServerUnavailableError:
+            # adb server not started yet, the adb binary starts it. any later error may come
+            # after the command already ran on the device, running it again is not safe
+            pass
+    return __run_subprocess(serial=serial, port=port, cmd=cmd, host=host, stdout=stdout, stderr=stderr)
+
+
+def __run_socket(serial, port, cmd, host):
+    c = client(host=host, port=port)
+    name, args = cmd[0], cmd[1:]
+    if name == "shell":
+        output = c.shell(serial, " ".join(args))
+    elif name == "exec-out":
+        return c.exec_out(serial, " ".join(args))
+    elif name == "push" and len(args) == 2:
+        c.push(serial, args[0], args[1])
+        return ""
+    elif name == "pull" and len(args) == 2:
+        c.pull(serial, args[0], args[1])
+        return ""
+    elif name == "connect" and len(args) == 1:
+        return c.connect(args[0])
+    elif name == "disconnect" and len(args) == 1:
+        return c.disconnect(args[0])
+    elif name == "forward" and len(args) == 2:
+        c.forward(serial, args[0], args[1])
+        return ""
+    elif name == "reboot":
+        c.reboot(serial, args[0] if args else "")
+        return ""
+    elif name == "get-state":
+        return c.get_state(serial)
+    else:
+        raise NotImplementedError(name)
+    return output.decode('utf-8').replace('\r\n', '\n')
+
+
+def __run_subprocess(serial, port, cmd, host, stdout, stderr):
     cmdline = [__adb_path()]
     if serial is not None and len(serial) > 0:
         cmdline = cmdline + ["-s", serial]
     if port is not None:
-        cmdline = cmdline + ["-P", port]
+        cmdline = cmdline + ["-P", str(port)]
     if host is not None and len(host) > 0:
         cmdline = cmdline + ["-H", host]
     cmdline = cmdline + cmd
@@ -37,242 +99,432 @@ def run(serial=None, port=5037, cmd=list(), host=None, stdout=None, stderr=None)
         stdout = subprocess.PIPE
     if stderr is None:
         stderr = subprocess.PIPE
-    return subprocess.Popen(cmdline, stdout=stdout, stderr=stderr
-                            ).communicate()[0].decode('utf-8').replace('\r\n', '\n')
+    output = subprocess.Popen(cmdline, stdout=stdout, stderr=stderr).communicate()[0]
+    if cmd[:1] == ["exec-out"]:
+        return output
+    return output.decode('utf-8').replace('\r\n', '\n')
 
 
-def su(serial, port, su_cmd=list()):
+def su(serial, port, su_cmd=list(), host=None):
     if len(su_cmd) > 0:
         cmd = ["su", "-c", "'%s'" % texts.strip(su_cmd)]
-        shell(serial=serial, port=port, sh=cmd)
+        shell(serial=serial, port=port, host=host, sh=cmd)
 
 
-def am(serial, port, am_cmd=list()):
+def am(serial, port, am_cmd=list(), host=None):
     cmd = ["am"] + am_cmd
-    shell(serial=serial, port=port, sh=cmd)
+    shell(serial=serial, port=port, host=host, sh=cmd)
 
 
-def pm(serial, port, pm_cmd=list()):
+def pm(serial, port, pm_cmd=list(), host=None):
     cmd = ["pm"] + pm_cmd
-    shell(serial=serial, port=port, sh=cmd)
+    shell(serial=serial, port=port, host=host, sh=cmd)
 
 
-def inputs(serial, port, input_cmd=list(), instance=0):
+def inputs(serial, port, input_cmd=list(), instance=0, host=None):
     # TODO handle instance
     cmd = ["input"] + input_cmd
-    shell(serial=serial, port=port, sh=cmd)
+    shell(serial=serial, port=port, host=host, sh=cmd)
 
 
-def dumpsys(serial, port, dumpsys_cmd=list()):
+def dumpsys(serial, port, dumpsys_cmd=list(), host=None):
     cmd = ["dumpsys"] + dumpsys_cmd
-    shell(serial=serial, port=port, sh=cmd)
-
-
-def shell(serial, port, sh=list()):
+    shell(serial=serial, port=port, host=host, sh=cmd)
+
+
+def __session_key(serial, port, host):
+    return host or __adb_host(), str(port or __adb_port()), serial
+
+
+def open_session(serial, port, host=None, timeout=None):
+    """
+    keep one remote sh open for the device, shell() runs every later command through it
+
+    @param timeout default seconds a command may take, None lets every command run until it ends
+    """
+    key = __session_key(serial, port, host)
+    session = _sessions.get(key)
+    if session is None:
+        session = adbclient.ShellSession(client(host=host, port=port), serial, timeout=timeout)
+        _sessions[key] = session
+    try:
+        session.open()
+    except (IOError, socket.error):
+        # device not ready yet, the first command opens it
+        pass
+    return session
+
+
+def close_session(serial, port, host=None):
+    session = _sessions.pop(__session_key(serial, port, host), None)
+    if session is not None:
+        session.close()
+
+
+def shell(serial, port, sh=list(), host=None, timeout=None):
+    """
+    @param timeout seconds to wait in a session, None waits until the command ends
+    """
+    session = _sessions.get(__session_key(serial, port, host)) if USE_SESSION else None
+    if session is not None:
+        try:
+            return session.execute(" ".join(sh), timeout=timeout)[1]
+        except adbclient.ShellSessionError:
+            # the command may already have run, do not run it a second time
+            raise
+        except (IOError, socket.error):
+            # session can not be reopened, a one-shot shell still may work
+            pass
     cmd = ["shell"] + sh
-    return run(serial=serial, port=port, cmd=cmd)
+    return run(serial=serial, port=port, host=host, cmd=cmd)
 
 
 @time_log
-def connect(serial, port):
+def connect(serial, port, host=None):
     cmd = ["connect", serial]
-    output = run(port=port, cmd=cmd)
+    output = run(port=port, host=host, cmd=cmd)
     return 'unable to connect' not in output
 
 
 @time_log
-def disconnect(serial, port):
+def disconnect(serial, port, host=None):
     cmd = ["disconnect", serial]
-    return run(port=port, cmd=cmd).wait()
+    return run(port=port, host=host, cmd=cmd)
 
 
 @time_log
-def forward(serial, local_port, remote_port=None):
+def forward(serial, local_port, remote_port=None, host=None, port=None):
     cmd = ["forward", "tcp:%d" % local_port, "tcp:%d" % remote_port]
-    run(serial=serial, cmd=cmd)
+    run(serial=serial, port=port, host=host, cmd=cmd)
 
 
 @time_log
-def am_force_stop(serial, port, package_name, instance):
+def am_force_stop(serial, port, package_name, instance, host=None):
     pk = "%s@#%s" % (package_name, instance)
     cmd = ["force-stop", pk]
-    am(serial=serial, port=port, am_cmd=cmd)
+    am(serial=serial, port=port, host=host, am_cmd=cmd)
 
 
 @time_log
-def am_start(serial, port, package_name, activity_name, instance):
+def am_start(serial, port, package_name, activity_name, instance, host=None):
     ac = "%s/%s" % (package_name, activity_name)
     cmd = ["start", ac]
-    am(serial=serial, port=port, am_cmd=cmd)
+    am(serial=serial, port=port, host=host, am_cmd=cmd)
 
 
 @time_log
-def pm_install(serial, port, local_path):
+def pm_install(serial, port, local_path, host=None):
     cmd = ["install", local_path]
-    pm(serial=serial, port=port, pm_cmd=cmd)
+    pm(serial=serial, port=port, host=host, pm_cmd=cmd)
 
 
 @time_log
-def pm_uninstall(serial, port, package_name):
+def pm_uninstall(serial, port, package_name, host=None):
     cmd = ["uninstall", package_name]
-    pm(serial=serial, port=port, pm_cmd=cmd)
+    pm(serial=serial, port=port, host=host, pm_cmd=cmd)
 
 
 @time_log
-def type(serial, port, message, instance=0):
+def type(serial, port, message, instance=0, host=None):
     if texts.is_ascii(message):
-        _type(serial=serial, port=port, message=message, instance=instance)
+        _type(serial=serial, port=port, host=host, message=message, instance=instance)
     else:
-        _type_chinese(serial=serial, port=port, message=message, instance=instance)
+        _type_chinese(serial=serial, port=port, host=host, message=message, instance=instance)
 
 
 @time_log
-def _type(serial, port, message, instance=0):
+def _type(serial, port, message, instance=0, host=None):
     cmd = ["text", texts.strip(message)]
-    inputs(serial=serial, port=port, input_cmd=cmd, instance=instance)
+    inputs(serial=serial, port=port, host=host, input_cmd=cmd, instance=instance)
 
 
 @time_log
-def _type_chinese(serial, port, message, instance=0):
+def _type_chinese(serial, port, message, instance=0, host=None):
     cmd = ["chinese", texts.strip(message)]
-    inputs(serial=serial, port=port, input_cmd=cmd, instance=instance)
+    inputs(serial=serial, port=port, host=host, input_cmd=cmd, instance=instance)
 
 
 @time_log
-def tap(serial, port, x, y, instance=0):
+def tap(serial, port, x, y, instance=0, host=None):
     cmd = ["tap", str(x), str(y)]
-    inputs(serial=serial, port=port, input_cmd=cmd, instance=instance)
+    inputs(serial=serial, port=port, host=host, input_cmd=cmd, instance=instance)
 
 
 @time_log
-def swipe(serial, port, x1, y1, x2, y2, instance=0):
+def swipe(serial, port, x1, y1, x2, y2, instance=0, host=None):
     cmd = ["swipe", str(x1), str(y1), str(x2), str(y2)]
-    inputs(serial=serial, port=port, input_cmd=cmd, instance=instance)
+    inputs(serial=serial, port=port, host=host, input_cmd=cmd, instance=instance)
 
 
-def key_event(serial, port, key, instance=0):
+def key_event(serial, port, key, instance=0, host=None):
     cmd = ["keyevent", key]
-    inputs(serial=serial, port=port, input_cmd=cmd, instance=instance)
+    inputs(serial=serial, port=port, host=host, input_cmd=cmd, instance=instance)
 
 
 @time_log
-def back(serial, port, instance=0):
-    key_event(serial=serial, port=port, key="KEYCODE_BACK", instance=instance)
+def back(serial, port, instance=0, host=None):
+    key_event(serial=serial, port=port, host=host, key="KEYCODE_BACK", instance=instance)
 
 
 @time_log
-def home(serial, port, instance=0):
-    key_event(serial=serial, port=port, key="KEYCODE_HOME", instance=instance)
+def home(serial, port, instance=0, host=None):
+    key_event(serial=serial, port=port, host=host, key="KEYCODE_HOME", instance=instance)
 
 
 @time_log
-def del_input(serial, port, instance=0):
-    key_event(serial=serial, port=port, key="KEYCODE_DEL", instance=instance)
+def del_input(serial, port, instance=0, host=None):
+    key_event(serial=serial, port=port, host=host, key="KEYCODE_DEL", instance=instance)
+
+
+class InputBatch(object):
+    """
+    queue input events and send them in order as one shell invocation
+
+        batch = InputBatch(serial, port)
+        batch.tap(100, 200)
+        batch.key_event("KEYCODE_DEL", repeat=20)
+        batch.text("hello")
+        batch.flush()
+
+    consecutive key events share one `input keyevent k1 k2 ...`, a delay becomes `sleep`.
+    """
+
+    def __init__(self, serial, port, host=None):
+        self.serial = serial
+        self.port = port
+        self.host = host
+        self._commands = []
+        self._keys = []
+
+    def __len__(self):
+        return len(self._commands) + (1 if self._keys else 0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.flush()
+
+    def tap(self, x, y):
+        return self.__add("input tap %d %d" % (x, y))
+
+    def swipe(self, x1, y1, x2, y2, duration=None):
+        cmd = "input swipe %d %d %d %d" % (x1, y1, x2, y2)
+        if duration is not None:
+            cmd += " %d" % int(duration * 1000)
+        return self.__add(cmd)
+
+    def key_event(self, key, repeat=1):
+        self._keys.extend([str(key)] * repeat)
+        return self
+
+    def text(self, message):
+        if texts.is_ascii(message):
+            return self.__add("input text %s" % texts.strip(message))
+        return self.__add("input chinese %s" % texts.strip(message))
+
+    def sleep(self, seconds):
+        return self.__add("sleep %s" % seconds)
+
+    def command(self):
+        """
+        @return the shell command line flush() would run
+        """
+        commands = self._commands + (["input keyevent " + " ".join(self._keys)] if self._keys else [])
+        return "; ".join(commands)
+
+    def flush(self):
+        cmd = self.command()
+        self._commands = []
+        self._keys = []
+        if cmd:
+            shell(serial=self.serial, port=self.port, host=self.host, sh=[cmd])
+
+    def __add(self, cmd):
+        if self._keys:
+            self._commands.append("input keyevent " + " ".join(self._keys))
+            self._keys = []
+        self._commands.append(cmd)
+        return self
 
 
 @time_log
-def screen_cap(serial, port, remote_path, display_id=None):
+def screen_cap(serial, port, remote_path, display_id=None, host=None):
     if display_id is None:
         cmd = ["screencap", "-p", remote_path]
     else:
         cmd = ["screencap", "-p", remote_path, "-d", str(display_id)]
-    shell(serial=serial, port=port, sh=cmd)
+    shell(serial=serial, port=port, host=host, sh=cmd)
+
+
+@time_log
+def screen_cap_raw(serial, port, display_id=None, host=None):
+    """
+    screencap without -p: header + raw pixels streamed back, nothing written on the device
+    """
+    cmd = ["exec-out", "screencap"]
+    if display_id is not None:
+        cmd = cmd + ["-d", str(display_id)]
+    return run(serial=serial, port=port, host=host, cmd=cmd)
 
 
 @time_log
-def match(serial, port, remote_object_path, remote_scanner_path):
+def match(serial, port, remote_object_path, remote_scanner_path, host=None):
     cmd = ["cv", "match", remote_object_path, remote_scanner_path]
-    return shell(serial=serial, port=port, sh=cmd)
+    return shell(serial=serial, port=port, host=host, sh=cmd)
+
+
+@time_log
+def capture_match(serial, port, remote_object_path, display_id=None, host=None):
+    """
+    screencap and cv match in one shell invocation, the screen file never outlives the call
+    """
+    screen = "/data/local/tmp/atx_screen_%s.png" % texts.unique(8)
+    capture = "screencap -p %s" % screen
+    if display_id is not None:
+        capture += " -d %s" % display_id
+    cmd = ["%s && cv match %s %s; rm -f %s" % (capture, remote_object_path, screen, screen)]
+    return shell(serial=serial, port=port, host=host, sh=cmd)
+
+
+@time_log
+def capture_match_many(serial, port, remote_object_paths, display_id=None, host=None):
+    """
+    one screencap, `cv match` for every template against it, all in a single shell invocation
+
+    @return dict remote_object_path -> cv match output
+    """
+    screen = "/data/local/tmp/atx_screen_%s.png" % texts.unique(8)
+    capture = "screencap -p %s" % screen
+    if display_id is not None:
+        capture += " -d %s" % display_id
+    loop = "for t in %s; do echo ATX_T$t; cv match $t %s; done" % (" ".join(remote_object_paths), screen)
+    cmd = ["%s && %s; rm -f %s" % (capture, loop, screen)]
+    output = shell(serial=serial, port=port, host=host, sh=cmd)
+    # unicode like the shell output, computer_match refuses byte strings
+    results = dict.fromkeys(remote_object_paths, u"")
+    current = None
+    for line in output.splitlines():
+        if line.startswith("ATX_T"):
+            current = line[len("ATX_T"):].strip()
+        elif current in results:
+            results[current] += line + "\n"
+    return results
+
+
+@time_log
+def start_match_server(serial, port, remote_port, host=None):
+    """
+    launch the device side match server (`cv serve <port>`), see atx.utils.match_server
+    """
+    cmd = ["nohup cv serve %d >/dev/null 2>&1 &" % remote_port]
+    shell(serial=serial, port=port, host=host, sh=cmd)
+
+
+@time_log
+def ui_dump(serial, port, host=None):
+    """
+    uiautomator hierarchy of the current window, dumped and read back in one shell invocation
+
+    @return xml string, empty when the dump failed
+    """
+    remote_path = "/data/local/tmp/atx_ui_%s.xml" % texts.unique(8)
+    cmd = ["uiautomator dump %s >/dev/null 2>&1 && cat %s; rm -f %s" % (remote_path, remote_path, remote_path)]
+    output = shell(serial=serial, port=port, host=host, sh=cmd)
+    pos = output.find("<?xml")
+    return output[pos:] if pos != -1 else ""
+
+
+def surface_flip_count(serial, port, host=None, timeout=PROBE_TIMEOUT):
+    """
+    SurfaceFlinger page flip counter, grows with every composed frame
+
+    @return int or None when the ROM does not answer the transaction
+    """
+    output = shell(serial=serial, port=port, host=host, sh=FLIP_COUNT_CMD, timeout=timeout)
+    return parse_flip_count(output)
+
+
+def parse_flip_count(output):
+    # Result: Parcel(00000000 00012ab4   '........')
+    m = re.search(r'Parcel\(\s*([0-9a-fA-F]{8})\s+([0-9a-fA-F]{8})', output)
+    if m is None or int(m.group(1), 16) != 0:
+        return None
+    return int(m.group(2), 16)
 
 
 @time_log
-def push(serial, port, local_path, remote_path):
+def push(serial, port, local_path, remote_path, host=None):
     cmd = ["push", local_path, remote_path]
-    run(serial=serial, port=port, cmd=cmd)
+    run(serial=serial, port=port, host=host, cmd=cmd)
 
 
 @time_log
-def pull(serial, port, remote_path, local_path):
+def pull(serial, port, remote_path, local_path, host=None):
     cmd = ["pull", remote_path, local_path]
-    run(serial=serial, port=port, cmd=cmd)
+    run(serial=serial, port=port, host=host, cmd=cmd)
 
 
 @time_log
-def sync(serial, port, remote_path, local_path):
+def sync(serial, port, remote_path, local_path, host=None):
     # TODO to be test
     cmd = ["sync", remote_path, local_path]
-    run(serial=serial, port=port, cmd=cmd)
+    run(serial=serial, port=port, host=host, cmd=cmd)
 
 
 @time_log
-def power_off(serial, port):
-    run(serial=serial, port=port, cmd=["poweroff"])
+def power_off(serial, port, host=None):
+    run(serial=serial, port=port, host=host, cmd=["poweroff"])
 
 
 @time_log
-def reboot(serial, port):
-    run(serial=serial, port=port, cmd=["reboot"])
+def reboot(serial, port, host=None):
+    run(serial=serial, port=port, host=host, cmd=["reboot"])
 
 
-def which(serial, port, which_cmd):
+def which(serial, port, which_cmd, host=None):
     cmd = ["which", which_cmd]
-    return shell(serial=serial, port=port, sh=cmd)
+    return shell(serial=serial, port=port, host=host, sh=cmd)
 
 
-def rm(serial, port, remote_path):
+def rm(serial, port, remote_path, host=None):
     if isinstance(remote_path, str):
         cmd = ["rm", "-r", remote_path]
     elif isinstance(remote_path, list):
         cmd = ["rm", "-r"] + remote_path
     else:
         raise ValueError("un except input")
-    shell(serial=serial, port=port, sh=cmd)
+    shell(serial=serial, port=port, host=host, sh=cmd)
 
 
 @time_log
-def cpu_usage(serial, port):
-    cmd = "adb -s %s -p %s shell top -bn1" % (serial, port)
-    cmd += " | grep 'cpu' | grep 'user' | awk  '{print $1}{print $5}' | cut -d '%' -f1"
-    pipe = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    error = pipe.stderr.readline().strip()
-    cpu = pipe.stdout.readline().strip()
-    idle = pipe.stdout.readline().strip()
-    pipe.stdout.close()
-    pipe.stderr.close()
-    if len(error) > 0:
-        raise ValueError(error)
-    if cpu and idle and idle.isdigit() and cpu.isdigit():
-        return 1 - float(idle) / float(cpu)
+def cpu_usage(serial, port, host=None):
+    # 800%cpu  12%user   0%nice  10%sys 778%idle ...
+    for line in shell(serial=serial, port=port, host=host, sh=["top", "-bn1"]).splitlines():
+        if 'cpu' in line and 'user' in line:
+            fields = [f.split('%')[0] for f in line.split()]
+            if len(fields) > 4 and fields[0].isdigit() and fields[4].isdigit():
+                return 1 - float(fields[4]) / float(fields[0])
     return 0
 
 
 @time_log
-def mem_usage(serial, port):
-    cmd = "adb -s %s -p %s  shell top -bn1" % (serial, port)
-    cmd += " | grep 'Mem:' | grep 'total' | awk '{print $2}{print $4 }' | cut -d 'k' -f1"
-    pipe = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    error = pipe.stderr.readline().strip()
-    total = pipe.stdout.readline().strip()
-    used = pipe.stdout.readline().strip()
-    pipe.stdout.close()
-    pipe.stderr.close()
-    if len(error) > 0:
-        raise ValueError(error)
-    if total and used and used.isdigit() and total.isdigit():
-        return float(used) / float(total)
+def mem_usage(serial, port, host=None):
+    # Mem:   3838260k total,  3600000k used, ...
+    for line in shell(serial=serial, port=port, host=host, sh=["top", "-bn1"]).splitlines():
+        if 'Mem:' in line and 'total' in line:
+            fields = [f.split('k')[0] for f in line.split()]
+            if len(fields) > 3 and fields[1].isdigit() and fields[3].isdigit():
+                return float(fields[3]) / float(fields[1])
     return 0
 
 
 @time_log
-def temperature(serial, port):
-    cmd = "adb -s %s -p %s shell dumpsys battery | grep 'temperature' | cut -d ':' -f2" % (serial, port)
-    pipe = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out = pipe.stdout.readline().strip()
-    error = pipe.stderr.readline().strip()
-    pipe.stdout.close()
-    pipe.stderr.close()
-    if len(error) > 0:
-        raise ValueError(error)
-    if out and out.isdigit():
-        return float(out) / 10
+def temperature(serial, port, host=None):
+    for line in shell(serial=serial, port=port, host=host, sh=["dumpsys", "battery"]).splitlines():
+        if 'temperature' in line:
+            out = line.split(':')[-1].strip()
+            if out.isdigit():
+                return float(out) / 10
     return 0
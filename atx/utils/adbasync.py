@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Yeshen'
+
+#
+# the adb host protocol of atx.utils.adbclient on tornado streams: every
+# service is a coroutine, one IOLoop thread drives any number of devices.
+#
+
+import socket
+
+from tornado import gen
+from tornado.iostream import IOStream, StreamClosedError
+
+from atx.utils.adbclient import AdbError, ServerUnavailableError, DEFAULT_HOST, DEFAULT_PORT, _encode
+
+
+class AsyncAdbClient(object):
+    def __init__(self, host=None, port=None):
+        self.host = host or DEFAULT_HOST
+        self.port = int(port or DEFAULT_PORT)
+
+    @gen.coroutine
+    def connection(self):
+        stream = IOStream(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+        try:
+            yield stream.connect((self.host, self.port))
+        except StreamClosedError as e:
+            raise ServerUnavailableError("adb server %s:%d not reachable: %s" % (self.host, self.port, e))
+        stream.set_nodelay(True)
+        raise gen.Return(stream)
+
+    @gen.coroutine
+    def request(self, stream, service):
+        service = _encode(service)
+        yield stream.write(b'%04x' % len(service) + service)
+        status = yield stream.read_bytes(4)
+        if status == b'OKAY':
+            return
+        if status == b'FAIL':
+            size = yield stream.read_bytes(4)
+            message = yield stream.read_bytes(int(size, 16))
+            raise AdbError(message.decode('utf-8'))
+        raise AdbError("unknown adb status %r" % status)
+
+    @gen.coroutine
+    def service(self, serial, service):
+        """
+        @return everything the service writes until it closes the connection
+        """
+        stream = yield self.connection()
+        try:
+            yield self.request(stream, "host:transport:%s" % serial if serial else "host:transport-any")
+            yield self.request(stream, service)
+            data = yield stream.read_until_close()
+        except StreamClosedError as e:
+            raise AdbError("adb connection closed: %s" % e)
+        finally:
+            stream.close()
+        raise gen.Return(data)
+
+    @gen.coroutine
+    def shell(self, serial, command):
+        output = yield self.service(serial, "shell:%s" % command)
+        raise gen.Return(output.decode('utf-8').replace('\r\n', '\n'))
+
+    @gen.coroutine
+    def exec_out(self, serial, command):
+        """
+        raw output, no pty and no \\r\\n translation
+        """
+        output = yield self.service(serial, "exec:%s" % command)
+        raise gen.Return(output)
@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Yeshen'
+
+import os
+import socket
+import struct
+import threading
+import time
+
+DEFAULT_HOST = "localhost"
+DEFAULT_PORT = 5037
+SYNC_CHUNK = 64 * 1024
+
+
+class AdbError(IOError):
+    pass
+
+
+class ServerUnavailableError(AdbError):
+    """
+    no connection to the adb server, nothing reached the device
+    """
+    pass
+
+
+def _encode(s):
+    if isinstance(s, bytes):
+        return s
+    return s.encode('utf-8')
+
+
+class Connection(object):
+    """
+    one socket to the adb server, every smart-socket service consumes one connection
+    """
+
+    def __init__(self, host=None, port=None, timeout=None):
+        self.host = host or DEFAULT_HOST
+        self.port = int(port or DEFAULT_PORT)
+        try:
+            self.sock = socket.create_connection((self.host, self.port), timeout=timeout)
+        except socket.error as e:
+            raise ServerUnavailableError("adb server %s:%d not reachable: %s" % (self.host, self.port, e))
+        # small request/response frames, do not let nagle hold them back
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def send(self, data):
+        self.sock.sendall(_encode(data))
+
+    def recv_exactly(self, size):
+        chunks = []
+        while size > 0:
+            chunk = self.sock.recv(size)
+            if not chunk:
+                raise AdbError("adb connection closed unexpectedly")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def recv_all(self):
+        chunks = []
+        while True:
+            chunk = self.sock.recv(SYNC_CHUNK)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    def recv_string(self):
+        size = int(self.recv_exactly(4), 16)
+        return self.recv_exactly(size).decode('utf-8')
+
+    def request(self, service):
+        service = _encode(service)
+        self.send(b'%04x' % len(service) + service)
+        self.check_status()
+
+    def check_status(self):
+        status = self.recv_exactly(4)
+        if status == b'OKAY':
+            return
+        if status == b'FAIL':
+            raise AdbError(self.recv_string())
+        raise AdbError("unknown adb status %r" % status)
+
+
+class AdbClient(object):
+    """
+    talk to adb server with the host protocol instead of forking a new adb binary per command
+
+    https://android.googlesource.com/platform/system/core/+/master/adb/OVERVIEW.TXT
+    https://android.googlesource.com/platform/system/core/+/master/adb/SERVICES.TXT
+    """
+
+    def __init__(self, host=None, port=None, timeout=None):
+        self.host = host or DEFAULT_HOST
+        self.port = int(port or DEFAULT_PORT)
+        self.timeout = timeout
+
+    def connection(self):
+        return Connection(self.host, self.port, self.timeout)
+
+    def transport(self, serial=None):
+        conn = self.connection()
+        try:
+            if serial:
+                conn.request("host:transport:%s" % serial)
+            else:
+                conn.request("host:transport-any")
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    def version(self):
+        with self.connection() as conn:
+            conn.request("host:version")
+            return int(conn.recv_string(), 16)
+
+    def devices(self):
+        """
+        @return list of (serial, state)
+        """
+        with self.connection() as conn:
+            conn.request("host:devices")
+            output = conn.recv_string()
+        devices = []
+        for line in output.splitlines():
+            parts = line.strip().split('\t')
+            if len(parts) == 2:
+                devices.append((parts[0], parts[1]))
+        return devices
+
+    def get_state(self, serial=None):
+        service = "host-serial:%s:get-state" % serial if serial else "host:get-state"
+        with self.connection() as conn:
+            conn.request(service)
+            return conn.recv_string()
+
+    def connect(self, address):
+        with self.connection() as conn:
+            conn.request("host:connect:%s" % address)
+            return conn.recv_string()
+
+    def disconnect(self, address):
+        with self.connection() as conn:
+            conn.request("host:disconnect:%s" % address)
+            return conn.recv_string()
+
+    def forward(self, serial, local, remote):
+        service = "forward:%s;%s" % (local, remote)
+        if serial:
+            service = "host-serial:%s:%s" % (serial, service)
+        else:
+            service = "host:" + service
+        with self.connection() as conn:
+            conn.request(service)
+            try:
+                # newer servers answer OKAY twice: once for the transport, once for the forward
+                conn.check_status()
+            except (AdbError, socket.error):
+                pass
+
+    def open_service(self, serial, service):
+        """
+        @return connection positioned after the service OKAY, owned by the caller
+        """
+        conn = self.transport(serial)
+        try:
+            conn.request(service)
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    def service(self, serial, service):
+        with self.open_service(serial, service) as conn:
+            return conn.recv_all()
+
+    def shell(self, serial, command):
+        return self.service(serial, "shell:%s" % command)
+
+    def exec_out(self, serial, command):
+        """
+        raw output, no pty and no \\r\\n translation
+        """
+        return self.service(serial, "exec:%s" % command)
+
+    def reboot(self, serial, mode=''):
+        self.service(serial, "reboot:%s" % mode)
+
+    def push(self, serial, local_path, remote_path, mode=0o644):
+        with open(local_path, 'rb') as f:
+            data = f.read()
+        mtime = int(os.path.getmtime(local_path))
+        self.push_data(serial, data, remote_path, mode=mode, mtime=mtime)
+
+    def push_data(self, serial, data, remote_path, mode=0o644, mtime=None):
+        with self.open_service(serial, "sync:") as conn:
+            spec = _encode("%s,%d" % (remote_path, mode))
+            conn.send(b'SEND' + struct.pack('<I', len(spec)) + spec)
+            for offset in range(0, len(data), SYNC_CHUNK):
+                chunk = data[offset:offset + SYNC_CHUNK]
+                conn.send(b'DATA' + struct.pack('<I', len(chunk)) + chunk)
+            conn.send(b'DONE' + struct.pack('<I', int(mtime or time.time())))
+            status = conn.recv_exactly(4)
+            size = struct.unpack('<I', conn.recv_exactly(4))[0]
+            if status == b'FAIL':
+                raise AdbError(conn.recv_exactly(size).decode('utf-8'))
+            conn.send(b'QUIT' + struct.pack('<I', 0))
+
+    def pull(self, serial, remote_path, local_path):
+        data = self.pull_data(serial, remote_path)
+        with open(local_path, 'wb') as f:
+            f.write(data)
+
+    def pull_data(self, serial, remote_path):
+        with self.open_service(serial, "sync:") as conn:
+            path = _encode(remote_path)
+            conn.send(b'RECV' + struct.pack('<I', len(path)) + path)
+            chunks = []
+            while True:
+                header = conn.recv_exactly(8)
+                cmd, size = header[:4], struct.unpack('<I', header[4:])[0]
+                if cmd == b'DATA':
+                    chunks.append(conn.recv_exactly(size))
+                elif cmd == b'DONE':
+                    break
+                elif cmd == b'FAIL':
+                    raise AdbError(conn.recv_exactly(size).decode('utf-8'))
+                else:
+                    raise AdbError("unknown sync response %r" % cmd)
+            conn.send(b'QUIT' + struct.pack('<I', 0))
+            return b''.join(chunks)
+
+    def stat(self, serial, remote_path):
+        """
+        @return (mode, size, mtime), mode is 0 when remote_path not exists
+        """
+        with self.open_service(serial, "sync:") as conn:
+            path = _encode(remote_path)
+            conn.send(b'STAT' + struct.pack('<I', len(path)) + path)
+            header = conn.recv_exactly(16)
+            if header[:4] != b'STAT':
+                raise AdbError("unknown sync response %r" % header[:4])
+            conn.send(b'QUIT' + struct.pack('<I', 0))
+            return struct.unpack('<III', header[4:])
+
+
+class ShellSessionError(AdbError):
+    """
+    the session broke after the command was sent, it may already have run on the device
+    """
+    pass
+
+
+class ShellTimeoutError(ShellSessionError):
+    pass
+
+
+class ShellSession(object):
+    """
+    one long-lived remote sh per device, commands are framed by sentinels:
+
+        echo ATX_""B<id>; ( cmd ) </dev/null; echo ATX_""E<id>$?
+
+    the empty quotes keep the markers out of a pty echo of the command line itself.
+    a hung or broken session is closed and reopened by the next call.
+    """
+
+    def __init__(self, client, serial=None, timeout=None):
+        self.client = client
+        self.serial = serial
+        self.timeout = timeout
+        self.conn = None
+        self.last_exit_code = None
+        self._seq = 0
+        self._buffer = b''
+        self._lock = threading.Lock()
+
+    def open(self):
+        if self.conn is not None:
+            return
+        try:
+            self.conn = self.client.open_service(self.serial, "exec:sh")
+        except AdbError:
+            # exec: needs android 5.0+, older adbd only has the pty shell
+            self.conn = self.client.open_service(self.serial, "shell:")
+        self._buffer = b''
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.send("exit\n")
+            except (IOError, socket.error):
+                pass
+            self.conn.close()
+            self.conn = None
+
+    def execute(self, command, timeout=None):
+        """
+        @param timeout seconds to wait for the output, defaults to the session timeout, None waits until it ends
+        @return (exit_code, output)
+        @raise ShellTimeoutError when no end marker arrives in time, the session is dropped
+        @raise ShellSessionError when the session breaks after the command was sent
+        """
+        with self._lock:
+            self._seq += 1
+            tag = "%d_%d" % (os.getpid(), self._seq)
+            line = 'echo ATX_""B%s; ( %s ) </dev/null; echo ATX_""E%s$?\n' % (tag, command, tag)
+            try:
+                self.open()
+                self.conn.send(line)
+            except (IOError, socket.error):
+                # the channel died between two commands, nothing was delivered yet
+                self.close()
+                self.open()
+                try:
+                    self.conn.send(line)
+                except (IOError, socket.error) as e:
+                    self.close()
+                    raise ShellSessionError("shell session broken: %s" % e)
+            try:
+                code, output = self.__read_frame(_encode("ATX_B" + tag), _encode("ATX_E" + tag),
+                                                 self.timeout if timeout is None else timeout)
+            except socket.timeout:
+                self.close()
+                raise ShellTimeoutError("shell session timeout: %s" % command)
+            except (IOError, socket.error) as e:
+                self.close()
+                raise ShellSessionError("shell session broken while running %s: %s" % (command, e))
+            self.last_exit_code = code
+            return code, output.decode('utf-8').replace('\r\n', '\n')
+
+    def __read_frame(self, begin, end, timeout):
+        deadline = time.time() + timeout if timeout is not None else None
+        start = None
+        while True:
+            if start is None:
+                pos = self._buffer.find(begin)
+                if pos != -1:
+                    eol = self._buffer.find(b'\n', pos)
+                    if eol != -1:
+                        start = eol + 1
+            if start is not None:
+                pos = self._buffer.find(end, start)
+                if pos != -1:
+                    eol = self._buffer.find(b'\n', pos)
+                    if eol != -1:
+                        output = self._buffer[start:pos]
+                        code = self._buffer[pos + len(end):eol].strip()
+                        self._buffer = self._buffer[eol + 1:]
+                        return int(code) if code.isdigit() else -1, output
+            if deadline is None:
+                self.conn.settimeout(None)
+            else:
+                remain = deadline - time.time()
+                if remain <= 0:
+                    raise socket.timeout()
+                self.conn.settimeout(remain)
+            chunk = self.conn.sock.recv(SYNC_CHUNK)
+            if not chunk:
+                raise AdbError("shell session closed")
+            self._buffer += chunk
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Yeshen'
+
+import collections
+import hashlib
+import os
+import re
+import socket
+import threading
+
+import atx.utils.adb as adb
+import atx.utils.texts as texts
+
+__date_re = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+
+class DeviceTemplateStore(object):
+    """
+    templates pushed once to <root>/<md5>.png and reused by every remote match
+
+    sync() learns what the device already holds with one shell round trip,
+    files whose content does not match their name are dropped. Least recently
+    used files are removed once the store grows beyond max_bytes.
+
+    a push goes to a temporary name and is renamed into place, so another
+    process sharing the device never reads a half written template.
+    """
+
+    def __init__(self, serial, port, host=None, root='/data/local/tmp/atx_templates', max_bytes=32 * 1024 * 1024):
+        self.serial = serial
+        self.port = port
+        self.host = host
+        self.root = root
+        self.max_bytes = max_bytes
+        self._present = collections.OrderedDict()  # md5 -> size, oldest first
+        self._bytes = 0
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def sync(self):
+        output = adb.shell(serial=self.serial, port=self.port, host=self.host,
+                           sh=["mkdir -p %s && cd %s && md5sum *.png 2>/dev/null; echo ATX_LS; ls -l" %
+                               (self.root, self.root)])
+        sums, _, listing = output.partition("ATX_LS")
+        valid = set()
+        broken = []
+        for line in sums.splitlines():
+            parts = line.split()
+            if len(parts) == 2:
+                digest, name = parts[0], os.path.basename(parts[1])
+                if name == digest + '.png':
+                    valid.add(digest)
+                else:
+                    broken.append(name)
+        with self._lock:
+            self._present.clear()
+            self._bytes = 0
+            for digest, size in _parse_ls(listing):
+                if digest in valid:
+                    self._present[digest] = size
+                    self._bytes += size
+        if broken:
+            self.__remove(broken)
+        self.__evict()
+        return len(self._present)
+
+    def ensure(self, local_path):
+        """
+        @return device path holding the content of local_path, pushed only when missing
+        @raise IOError when the push did not arrive
+        """
+        digest = self.digest(local_path)
+        remote_path = self.path_of(digest)
+        with self._lock:
+            if digest in self._present:
+                self._present[digest] = self._present.pop(digest)
+                return remote_path
+        tmp_path = '%s.%s.tmp' % (remote_path[:-len('.png')], texts.unique(8))
+        adb.push(serial=self.serial, port=self.port, host=self.host, local_path=local_path, remote_path=tmp_path)
+        size = os.path.getsize(local_path)
+        # adb push through the binary reports nothing, only what landed on the device tells
+        if self.__remote_size(tmp_path) != size or not self.__rename(tmp_path, remote_path):
+            self.__remove([os.path.basename(tmp_path)])
+            raise IOError("push %s to %s failed" % (local_path, remote_path))
+        with self._lock:
+            self._present[digest] = size
+            self._bytes += size
+        self.__evict(keep=digest)
+        return remote_path
+
+    def path_of(self, digest):
+        return '%s/%s.png' % (self.root, digest)
+
+    def digest(self, local_path):
+        st = os.stat(local_path)
+        key = (os.path.abspath(local_path), st.st_mtime, st.st_size)
+        digest = self._digests.get(key)
+        if digest is None:
+            with open(local_path, 'rb') as f:
+                digest = hashlib.md5(f.read()).hexdigest()
+            self._digests[key] = digest
+        return digest
+
+    def stats(self):
+        with self._lock:
+            return dict(count=len(self._present), bytes=self._bytes, max_bytes=self.max_bytes)
+
+    def __evict(self, keep=None):
+        victims = []
+        with self._lock:
+            for digest in list(self._present):
+                if self._bytes <= self.max_bytes:
+                    break
+                if digest == keep:
+                    continue
+                self._bytes -= self._present.pop(digest)
+                victims.append(digest + '.png')
+        if victims:
+            self.__remove(victims)
+
+    def __remote_size(self, remote_path):
+        """
+        @return size of remote_path on the device, None when it is missing
+        """
+        try:
+            mode, size, _ = adb.client(host=self.host, port=self.port).stat(self.serial, remote_path)
+            return size if mode else None
+        except (IOError, socket.error):
+            output = adb.shell(serial=self.serial, port=self.port, host=self.host,
+                               sh=["wc -c < %s 2>/dev/null" % remote_path]).strip()
+            return int(output) if output.isdigit() else None
+
+    def __rename(self, src, dst):
+        # rename() replaces dst in one step, a concurrent push of the same md5 holds the same bytes
+        output = adb.shell(serial=self.serial, port=self.port, host=self.host,
+                           sh=["mv %s %s && echo ATX_OK" % (src, dst)])
+        return 'ATX_OK' in output
+
+    def __remove(self, names):
+        adb.rm(serial=self.serial, port=self.port, host=self.host,
+               remote_path=['%s/%s' % (self.root, name) for name in names])
+
+
+def _parse_ls(listing):
+    """
+    yield (md5, size) from `ls -l`, size is the number right before the date column
+    """
+    for line in listing.splitlines():
+        parts = line.split()
+        if len(parts) < 5 or not parts[-1].endswith('.png'):
+            continue
+        for i in range(1, len(parts) - 1):
+            if __date_re.match(parts[i]) and parts[i - 1].isdigit():
+                yield parts[-1][:-len('.png')], int(parts[i - 1])
+                break
@@ -3,7 +3,14 @@
 
 __author__ = 'Yeshen'
 
+import collections
+import os
+import struct
+import threading
+
 import aircv as ac
+import cv2
+import numpy as np
 from atx.utils import time_log
 from atx import imutils
 
@@ -11,6 +18,25 @@ __screensize = (1920, 1080)
 __match_threshold = 0.8
 __scale = 3
 
+# 'pyramid' matches a downscaled level first and refines at full size, 'aircv' scans full size
+MATCH_ENGINE = 'pyramid'
+PYRAMID_SCALES = (0.25, 0.5)
+PYRAMID_MIN_SIDE = 12
+# a coarse peak below this can not turn into a full size match above __match_threshold
+PYRAMID_COARSE_REJECT = 0.5
+PYRAMID_MARGIN = 4
+# coarse peaks refined at full size, after non-max suppression: similar rows of a
+# list score alike on a coarse level and the best coarse peak is not always the target
+PYRAMID_PEAKS = 8
+# a full size confidence this high is taken without refining the remaining peaks
+PYRAMID_EXACT = 0.99
+# below this many candidate positions a direct full size correlation is cheaper than a pyramid
+PYRAMID_DIRECT_POSITIONS = 64 * 64
+# pixels around a remembered hit searched before the full scan
+HINT_MARGIN = 24
+# a hit around the remembered spot below this may be a similar neighbour, scan the full roi instead
+HINT_CONFIDENCE = 0.97
+
 
 class Error(Exception):
     def __init__(self, message, data=None):
@@ -30,44 +56,455 @@ class ImageNotFoundError(Error):
     pass
 
 
+class RawFormatError(IOError):
+    """
+    screencap raw output this decoder does not understand, not a transient read failure
+    """
+    pass
+
+
+Template = collections.namedtuple('Template', ['image', 'gray', 'levels'])
+MatchResult = collections.namedtuple('MatchResult', ['pos', 'rect', 'confidence'])
+
+
+def make_template(image):
+    """
+    precompute gray image and pyramid levels of a BGR template
+
+    @return Template
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    levels = {}
+    for scale in PYRAMID_SCALES:
+        h, w = gray.shape[:2]
+        if min(h, w) * scale >= PYRAMID_MIN_SIDE:
+            levels[scale] = cv2.resize(gray, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    for array in [image, gray] + list(levels.values()):
+        array.flags.writeable = False
+    return Template(image, gray, levels)
+
+
+class Scene(object):
+    """
+    one screen prepared for matching, gray and pyramid levels are built on first use
+    and shared by every template matched against it
+    """
+
+    def __init__(self, image):
+        self.image = image
+        self._gray = None
+        self._levels = {}
+
+    @property
+    def gray(self):
+        if self._gray is None:
+            self._gray = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+        return self._gray
+
+    def level(self, scale):
+        if scale not in self._levels:
+            self._levels[scale] = cv2.resize(self.gray, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return self._levels[scale]
+
+    def prepare(self):
+        """
+        build gray and every pyramid level up front, before the scene is shared across threads
+        """
+        for scale in PYRAMID_SCALES:
+            self.level(scale)
+        return self
+
+    @property
+    def size(self):
+        h, w = self.image.shape[:2]
+        return w, h
+
+    def crop(self, rect):
+        """
+        @return Scene over views of rect (left, top, right, bottom), clipped to the screen
+        """
+        w, h = self.size
+        left, top = max(0, int(rect[0])), max(0, int(rect[1]))
+        right, bottom = min(w, int(rect[2])), min(h, int(rect[3]))
+        sub = Scene(self.image[top:bottom, left:right])
+        if self._gray is not None:
+            sub._gray = self._gray[top:bottom, left:right]
+        return sub
+
+
+class HitMemory(object):
+    """
+    where each template was last found, per context (usually the top activity)
+    """
+
+    def __init__(self):
+        self._hits = {}
+        self._lock = threading.Lock()
+
+    def get(self, context, key):
+        with self._lock:
+            return self._hits.get((context, key))
+
+    def put(self, context, key, rect):
+        with self._lock:
+            self._hits[(context, key)] = rect
+
+    def forget(self, context, key):
+        with self._lock:
+            self._hits.pop((context, key), None)
+
+    def clear(self):
+        with self._lock:
+            self._hits.clear()
+
+
+hit_memory = HitMemory()
+
+
+class MatchGate(object):
+    """
+    remember how the searched region looked when a template was last missed
+
+    polling the same unchanged screen can only miss again, so the match is
+    skipped until a cell of the region thumbnail moves by more than threshold
+    gray levels. the region is the roi when given, the whole screen otherwise.
+    """
+
+    def __init__(self, size=(64, 36), threshold=8):
+        self.size = size
+        self.threshold = threshold
+        self.skipped = 0
+        self._misses = {}
+        self._lock = threading.Lock()
+
+    def signature(self, image, roi=None):
+        if roi is not None:
+            left, top = max(0, int(roi[0])), max(0, int(roi[1]))
+            image = image[top:int(roi[3]), left:int(roi[2])]
+        return imutils.thumbnail(image, self.size)
+
+    def unchanged(self, key, roi, signature):
+        """
+        @return True when key was missed on a region that looks the same as signature
+        """
+        with self._lock:
+            last = self._misses.get((key, roi))
+        if last is None or last.shape != signature.shape:
+            return False
+        if np.count_nonzero(cv2.absdiff(last, signature) > self.threshold):
+            return False
+        self.skipped += 1
+        return True
+
+    def miss(self, key, roi, signature):
+        with self._lock:
+            self._misses[(key, roi)] = signature
+
+    def hit(self, key, roi):
+        with self._lock:
+            self._misses.pop((key, roi), None)
+
+    def clear(self):
+        with self._lock:
+            self._misses.clear()
+
+
+class TemplateCache(object):
+    """
+    decoded templates keyed by (path, mtime, size, rect), LRU evicted under a byte budget
+
+    cached arrays are read-only, copy before drawing on them.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path, rect=None):
+        """
+        @return Template
+        @raise IOError when path can not be read as image
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            raise IOError("Open image(%s) not found" % path)
+        key = (os.path.abspath(path), st.st_mtime, st.st_size, tuple(rect) if rect is not None else None)
+        with self._lock:
+            template = self._items.pop(key, None)
+            if template is not None:
+                self.hits += 1
+                self._items[key] = template
+                return template
+            self.misses += 1
+        template = self.__load(path, rect)
+        with self._lock:
+            self._items[key] = template
+            self._bytes += self.__size(template)
+            while len(self._items) > 1 and self._bytes > self.max_bytes:
+                _, old = self._items.popitem(last=False)
+                self._bytes -= self.__size(old)
+        return template
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, count=len(self._items),
+                        bytes=self._bytes, max_bytes=self.max_bytes)
+
+    @staticmethod
+    def __load(path, rect):
+        return make_template(read_array(path, rect))
+
+    @staticmethod
+    def __size(template):
+        return template.image.nbytes + template.gray.nbytes + sum(v.nbytes for v in template.levels.values())
+
+
+template_cache = TemplateCache()
+
+
+def read_template(path, rect=None):
+    """
+    @return cached opencv BGR image of path, read-only
+    """
+    return template_cache.get(path, rect).image
+
+
+# screencap pixel formats, see android.graphics.PixelFormat
+__raw_formats = {
+    1: cv2.COLOR_RGBA2BGR,  # RGBA_8888
+    2: cv2.COLOR_RGBA2BGR,  # RGBX_8888
+    5: cv2.COLOR_BGRA2BGR,  # BGRA_8888
+}
+
+
 @time_log
 def read(path, rect=None):
+    return imutils.to_pillow(read_array(path, rect))
+
+
+def read_array(path, rect=None):
+    """
+    @return opencv BGR image, the crop is a view of the decoded image
+    """
     raw_image = imutils.open(path)
     if rect is not None:
         raw_image = imutils.crop(image=raw_image, left=rect[0], top=rect[1], right=rect[2], bottom=rect[3])
-    return imutils.to_pillow(raw_image)
+    return raw_image
+
+
+def from_png(data, rect=None):
+    """
+    decode `screencap -p` output to an opencv BGR image
+    """
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise IOError("png screencap not decodable, %d bytes" % len(data))
+    if rect is not None:
+        image = imutils.crop(image=image, left=rect[0], top=rect[1], right=rect[2], bottom=rect[3])
+    return image
 
 
 @time_log
-def match(target, scanner):
-    not_reusable_target = isinstance(target, str) or isinstance(target, unicode)
-    ret = None
-    if not_reusable_target:
-        target = read(target)
-    if isinstance(scanner, str) or isinstance(target, unicode):
-        scanner = read(scanner)
+def from_raw(data, rect=None):
+    """
+    decode `screencap` raw output (no -p) to an opencv BGR image
 
-    if ret is None:
-        ret = __match_template(scanner, target)
-    # TODO
-    # if ret is None:
-    #     ret = __match_sift(scanner, target)
+    header is width, height, format as little-endian uint32,
+    android 9+ appends a uint32 color space before the pixels
+    """
+    if data is None or len(data) < 12:
+        raise IOError("raw screencap too short")
+    width, height, fmt = struct.unpack('<III', data[:12])
+    if fmt not in __raw_formats:
+        raise RawFormatError("raw screencap format %d not supported" % fmt)
+    size = width * height * 4
+    if len(data) - 16 == size:
+        offset = 16
+    elif len(data) - 12 == size:
+        offset = 12
+    else:
+        raise RawFormatError("raw screencap size mismatch %d for %dx%d" % (len(data), width, height))
+    rgba = np.frombuffer(data, dtype=np.uint8, count=size, offset=offset).reshape((height, width, 4))
+    if rect is not None:
+        rgba = imutils.crop(image=rgba, left=rect[0], top=rect[1], right=rect[2], bottom=rect[3])
+    # the only copy: the cropped area converted to BGR
+    return cv2.cvtColor(rgba, __raw_formats[fmt])
+
+
+def as_template(target):
+    """
+    @return Template from a path (through template_cache), an image or a Template
+    """
+    if isinstance(target, Template):
+        return target
+    if isinstance(target, str) or isinstance(target, unicode):
+        return template_cache.get(target)
+    return make_template(__fuck(target))
 
-    if not_reusable_target:
-        del target
-    del scanner
 
+def as_scene(scanner):
+    """
+    @return Scene from a path, an image or a Scene
+    """
+    if isinstance(scanner, Scene):
+        return scanner
+    if isinstance(scanner, str) or isinstance(scanner, unicode):
+        return Scene(read_array(scanner))
+    return Scene(__fuck(scanner))
+
+
+@time_log
+def match(target, scanner):
+    ret = find(target, scanner)
     if ret is None:
         raise ImageNotFoundError(Error("match error"))
     else:
-        return ret
+        return ret.pos
+
+
+def match_threshold():
+    """
+    @return confidence a match has to exceed when no threshold is given
+    """
+    return __match_threshold
+
+
+def find(target, scanner, threshold=None, roi=None):
+    """
+    Args:
+        target: template path, BGR image or Template
+        scanner: screen path, BGR image or Scene
+        roi: only search inside (left, top, right, bottom) of scanner
+    @return MatchResult or None
+    """
+    target = as_template(target)
+    scanner = as_scene(scanner)
+    if threshold is None:
+        threshold = __match_threshold
+    if roi is not None:
+        left, top = max(0, int(roi[0])), max(0, int(roi[1]))
+        return __offset(find(target, scanner.crop(roi), threshold), left, top)
+
+    if MATCH_ENGINE == 'aircv':
+        return __match_template(scanner.image, target.image, threshold)
+    return __match_pyramid(scanner, target, threshold)
+
+
+def find_hinted(target, scanner, key, context=None, roi=None, threshold=None, memory=None):
+    """
+    search around the rect key was last found at in this context first,
+    fall back to roi (or the whole screen) on a miss and remember the new hit.
+    only a near-exact hit is taken from the remembered spot: once the target
+    moved, a similar list row there would still clear the threshold
+    """
+    if memory is None:
+        memory = hit_memory
+    target = as_template(target)
+    scanner = as_scene(scanner)
+    last = memory.get(context, key)
+    if last is not None:
+        window = (last[0] - HINT_MARGIN, last[1] - HINT_MARGIN, last[2] + HINT_MARGIN, last[3] + HINT_MARGIN)
+        if roi is not None:
+            window = (max(window[0], roi[0]), max(window[1], roi[1]), min(window[2], roi[2]), min(window[3], roi[3]))
+        if window[2] > window[0] and window[3] > window[1]:
+            ret = find(target, scanner, threshold=threshold, roi=window)
+            if ret is not None and ret.confidence >= HINT_CONFIDENCE:
+                memory.put(context, key, ret.rect)
+                return ret
+    ret = find(target, scanner, threshold=threshold, roi=roi)
+    if ret is not None:
+        memory.put(context, key, ret.rect)
+    return ret
+
+
+def __offset(ret, dx, dy):
+    if ret is None:
+        return None
+    (x, y), (left, top, right, bottom) = ret.pos, ret.rect
+    return MatchResult((x + dx, y + dy), (left + dx, top + dy, right + dx, bottom + dy), ret.confidence)
 
 
 @time_log
-def __match_template(scanner, target):
+def __match_template(scanner, target, threshold):
     ret = ac.find_template(__fuck(scanner), __fuck(target))
-    if ret and ret['confidence'] > __match_threshold:
-        return ret['result']
+    if ret and ret['confidence'] > threshold:
+        left, top = ret['rectangle'][0]
+        right, bottom = ret['rectangle'][3]
+        return MatchResult(ret['result'], (left, top, right, bottom), ret['confidence'])
+    return None
+
+
+def __best(image, template):
+    res = cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED)
+    _, confidence, _, loc = cv2.minMaxLoc(res)
+    return confidence, loc
+
+
+def __peaks(res, count, floor, radius):
+    """
+    @return up to count (value, (x, y)) local maxima of res above floor, strongest first,
+    no two closer than radius (rx, ry)
+    """
+    res = res.copy()
+    rx, ry = radius
+    peaks = []
+    while len(peaks) < count:
+        _, value, _, (x, y) = cv2.minMaxLoc(res)
+        if value < floor:
+            break
+        peaks.append((value, (x, y)))
+        res[max(0, y - ry):y + ry + 1, max(0, x - rx):x + rx + 1] = -1
+    return peaks
+
+
+@time_log
+def __match_pyramid(scene, template, threshold):
+    """
+    correlate on the coarsest usable pyramid level, then refine in a small window
+    around each of the strongest coarse peaks at full size and keep the best;
+    confidence is always the full size TM_CCOEFF_NORMED value, same measure as aircv
+    """
+    th, tw = template.gray.shape[:2]
+    sh, sw = scene.gray.shape[:2]
+    if th > sh or tw > sw:
+        return None
+
+    if not template.levels or (sw - tw + 1) * (sh - th + 1) <= PYRAMID_DIRECT_POSITIONS:
+        confidence, (left, top) = __best(scene.gray, template.gray)
+    else:
+        # coarsest level first, a finer level gets a chance when fine texture washed out the peak
+        confidence, left, top = -1, 0, 0
+        for scale in sorted(template.levels):
+            lh, lw = template.levels[scale].shape[:2]
+            res = cv2.matchTemplate(scene.level(scale), template.levels[scale], cv2.TM_CCOEFF_NORMED)
+            peaks = __peaks(res, PYRAMID_PEAKS, PYRAMID_COARSE_REJECT, (max(1, lw // 2), max(1, lh // 2)))
+            # one coarse pixel spans 1/scale full size pixels, plus rounding of the resize
+            margin = int(1.0 / scale) + PYRAMID_MARGIN
+            for _, (cx, cy) in peaks:
+                x0 = max(0, int(cx / scale) - margin)
+                y0 = max(0, int(cy / scale) - margin)
+                x1 = min(sw, int(cx / scale) + tw + margin)
+                y1 = min(sh, int(cy / scale) + th + margin)
+                fine, (dx, dy) = __best(scene.gray[y0:y1, x0:x1], template.gray)
+                if fine > confidence:
+                    confidence, left, top = fine, x0 + dx, y0 + dy
+                if confidence >= PYRAMID_EXACT:
+                    break
+            if confidence > threshold:
+                break
+
+    if confidence > threshold:
+        return MatchResult((left + tw / 2, top + th / 2), (left, top, left + tw, top + th), confidence)
     return None
 
 
@@ -83,3 +520,4 @@ def __match_sift(scanner, target):
 
 def __fuck(image):
     return imutils.from_pillow(image)
+
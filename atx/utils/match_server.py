@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Yeshen'
+
+#
+# binary protocol of the long-running match server, all little-endian
+#
+# request : 'ATXM' op:u8 req_id:u32 length:u32 payload
+# response: 'ATXR' status:u8 req_id:u32 length:u32 payload
+#
+# op PING  payload empty
+# op LOAD  payload template_id:u16 path:utf-8          preload once, match by id later
+# op MATCH payload display_id:i32 threshold:f32 count:u16 template_id:u16 * count
+#          response count * record(template_id:u16 found:u8 x:i16 y:i16 w:i16 h:i16 confidence:f32)
+#          x, y is the match center in screen pixels, one capture serves every id
+#
+# status 0 is ok, otherwise payload is an utf-8 error message
+#
+
+import collections
+import socket
+import struct
+import threading
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+REQUEST_MAGIC = b'ATXM'
+RESPONSE_MAGIC = b'ATXR'
+HEADER = struct.Struct('<4sBII')
+RECORD = struct.Struct('<HBhhhhf')
+MATCH_HEAD = struct.Struct('<ifH')
+
+OP_PING = 0
+OP_LOAD = 1
+OP_MATCH = 2
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+Record = collections.namedtuple('Record', ['template_id', 'found', 'pos', 'size', 'confidence'])
+
+
+class MatchServerError(IOError):
+    pass
+
+
+class MatchRequestError(MatchServerError):
+    """
+    the server answered with an error, the connection is still good
+    """
+    pass
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise MatchServerError("match server connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _read_message(sock, magic):
+    head, op, req_id, length = HEADER.unpack(_recv_exactly(sock, HEADER.size))
+    if head != magic:
+        raise MatchServerError("bad magic %r" % head)
+    return op, req_id, _recv_exactly(sock, length)
+
+
+def encode_records(records):
+    return b''.join(RECORD.pack(r.template_id, 1 if r.found else 0, int(r.pos[0]), int(r.pos[1]),
+                                int(r.size[0]), int(r.size[1]), r.confidence) for r in records)
+
+
+def decode_records(payload):
+    records = []
+    for offset in range(0, len(payload), RECORD.size):
+        tid, found, x, y, w, h, confidence = RECORD.unpack_from(payload, offset)
+        records.append(Record(tid, bool(found), (x, y), (w, h), confidence))
+    return records
+
+
+class MatchClient(object):
+    """
+    talk to the match server through a forwarded local port, one request at a time
+    """
+
+    def __init__(self, host='127.0.0.1', port=None, timeout=10):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._sock = None
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def connect(self):
+        if self._sock is None:
+            self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return self
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def ping(self):
+        self.__call(OP_PING, b'')
+        return True
+
+    def load(self, template_id, remote_path):
+        self.__call(OP_LOAD, struct.pack('<H', template_id) + remote_path.encode('utf-8'))
+
+    def match(self, template_ids, display_id=None, threshold=0.8):
+        """
+        @return list of Record, in the order of template_ids
+        """
+        payload = MATCH_HEAD.pack(-1 if display_id is None else int(display_id), threshold, len(template_ids))
+        payload += struct.pack('<%dH' % len(template_ids), *template_ids)
+        return decode_records(self.__call(OP_MATCH, payload))
+
+    def __call(self, op, payload):
+        with self._lock:
+            self._seq += 1
+            try:
+                self.connect()
+                self._sock.sendall(HEADER.pack(REQUEST_MAGIC, op, self._seq, len(payload)) + payload)
+                status, req_id, body = _read_message(self._sock, RESPONSE_MAGIC)
+            except (socket.error, MatchServerError):
+                self.close()
+                raise
+            if req_id != self._seq:
+                self.close()
+                raise MatchServerError("response %d for request %d" % (req_id, self._seq))
+            if status != STATUS_OK:
+                raise MatchRequestError(body.decode('utf-8'))
+            return body
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        while True:
+            try:
+                op, req_id, payload = _read_message(self.request, REQUEST_MAGIC)
+            except (socket.error, MatchServerError):
+                return
+            try:
+                body = server.dispatch(op, payload)
+                status = STATUS_OK
+            except Exception as e:
+                body = ('%s' % e).encode('utf-8')
+                status = STATUS_ERROR
+            self.request.sendall(HEADER.pack(RESPONSE_MAGIC, status, req_id, len(body)) + body)
+
+
+class LocalMatchServer(socketserver.ThreadingTCPServer):
+    """
+    host side stand-in of the device server, same protocol, matching done by atx.utils.images
+
+    Args:
+        capture: callable(display_id) return the BGR screen
+        resolve: callable(path) return the local template path, identity by default
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, capture, address=('127.0.0.1', 0), resolve=None):
+        socketserver.ThreadingTCPServer.__init__(self, address, _Handler)
+        self.capture = capture
+        self.resolve = resolve or (lambda path: path)
+        self.templates = {}
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(name='match-server', target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def dispatch(self, op, payload):
+        from atx.utils import images
+        if op == OP_PING:
+            return b''
+        if op == OP_LOAD:
+            template_id = struct.unpack_from('<H', payload)[0]
+            self.templates[template_id] = images.template_cache.get(self.resolve(payload[2:].decode('utf-8')))
+            return b''
+        if op == OP_MATCH:
+            display_id, threshold, count = MATCH_HEAD.unpack_from(payload)
+            ids = struct.unpack_from('<%dH' % count, payload, MATCH_HEAD.size)
+            scene = images.Scene(self.capture(None if display_id < 0 else display_id)).prepare()
+            records = []
+            for tid in ids:
+                if tid not in self.templates:
+                    raise KeyError("template %d not loaded" % tid)
+                ret = images.find(self.templates[tid], scene, threshold=threshold)
+                if ret is None:
+                    records.append(Record(tid, False, (0, 0), (0, 0), 0.0))
+                else:
+                    left, top, right, bottom = ret.rect
+                    records.append(Record(tid, True, ret.pos, (right - left, bottom - top), ret.confidence))
+            return encode_records(records)
+        raise ValueError("unknown op %d" % op)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Yeshen'
+
+#
+# touch injection by writing multitouch events to the touchscreen node with
+# `sendevent`, a tiny native binary, instead of the JVM backed `input` command.
+#
+# https://www.kernel.org/doc/Documentation/input/multi-touch-protocol.txt
+#
+
+import re
+
+import atx.utils.adb as adb
+
+EV_SYN = 0
+EV_KEY = 1
+EV_ABS = 3
+SYN_REPORT = 0
+SYN_MT_REPORT = 2
+BTN_TOUCH = 0x14a
+ABS_MT_SLOT = 0x2f
+ABS_MT_TOUCH_MAJOR = 0x30
+ABS_MT_POSITION_X = 0x35
+ABS_MT_POSITION_Y = 0x36
+ABS_MT_TRACKING_ID = 0x39
+ABS_MT_PRESSURE = 0x3a
+
+# seconds between two move frames of a gesture
+STEP_TIME = 0.02
+
+__section_re = re.compile(r'^([A-Z]+)?\s*\(([0-9a-f]{4})\):')
+__abs_re = re.compile(r'([0-9a-f]{4})\s*:\s*value -?\d+, min (-?\d+), max (-?\d+)')
+__size_re = re.compile(r'(Physical|Override) size: (\d+)x(\d+)')
+__orientation_re = re.compile(r'SurfaceOrientation: (\d)')
+
+
+class TouchScreen(object):
+    """
+    one touchscreen node with its axis ranges, maps screen pixels to panel units
+
+    Args:
+        axes: dict abs code -> (min, max)
+        keys: set of key codes the node reports
+        size: (width, height) of the screen in the natural orientation
+        rotation: 0-3, quarter turns of the screen
+    """
+
+    def __init__(self, path, name, axes, keys, size, rotation=0):
+        self.path = path
+        self.name = name
+        self.axes = axes
+        self.keys = keys
+        self.size = size
+        self.rotation = rotation
+        self._tracking_id = 0
+
+    def __repr__(self):
+        return 'TouchScreen(%s, %s)' % (self.path, self.name)
+
+    @property
+    def slots(self):
+        """
+        max number of fingers, 0 for a type A (slotless) device
+        """
+        if ABS_MT_SLOT not in self.axes:
+            return 0
+        low, high = self.axes[ABS_MT_SLOT]
+        return high - low + 1
+
+    def to_device(self, x, y):
+        w, h = self.size
+        # back from the rotated screen to the natural orientation of the panel
+        rotation = self.rotation % 4
+        if rotation == 1:
+            x, y = w - 1 - y, x
+        elif rotation == 2:
+            x, y = w - 1 - x, h - 1 - y
+        elif rotation == 3:
+            x, y = y, h - 1 - x
+        (x_min, x_max), (y_min, y_max) = self.axes[ABS_MT_POSITION_X], self.axes[ABS_MT_POSITION_Y]
+        dx = x_min + int(1.0 * x * (x_max - x_min + 1) / w)
+        dy = y_min + int(1.0 * y * (y_max - y_min + 1) / h)
+        return min(max(dx, x_min), x_max), min(max(dy, y_min), y_max)
+
+    def gesture(self, paths, duration=0.0):
+        """
+        Args:
+            paths: one list of (x, y) screen points per finger, fingers move through their points together
+            duration: seconds from touch down to touch up
+        @return list of (type, code, value), None marks a STEP_TIME pause
+        """
+        if self.slots and len(paths) > self.slots:
+            raise ValueError("%s supports %d fingers" % (self.path, self.slots))
+        steps = max(2, int(duration / STEP_TIME) + 1) if duration > 0 else 1
+        frames = [[self.to_device(*_interpolate(path, 1.0 * i / max(1, steps - 1))) for path in paths]
+                  for i in range(steps)]
+        events = []
+        for finger, (x, y) in enumerate(frames[0]):
+            self._tracking_id = (self._tracking_id + 1) % 0xffff
+            events += self.__finger(finger, x, y, tracking_id=self._tracking_id)
+        if BTN_TOUCH in self.keys:
+            events.append((EV_KEY, BTN_TOUCH, 1))
+        events.append((EV_SYN, SYN_REPORT, 0))
+        for frame in frames[1:]:
+            events.append(None)
+            for finger, (x, y) in enumerate(frame):
+                events += self.__finger(finger, x, y)
+            events.append((EV_SYN, SYN_REPORT, 0))
+        if self.slots:
+            for finger in range(len(paths)):
+                events += [(EV_ABS, ABS_MT_SLOT, finger), (EV_ABS, ABS_MT_TRACKING_ID, -1)]
+        else:
+            events.append((EV_SYN, SYN_MT_REPORT, 0))
+        if BTN_TOUCH in self.keys:
+            events.append((EV_KEY, BTN_TOUCH, 0))
+        events.append((EV_SYN, SYN_REPORT, 0))
+        return events
+
+    def command(self, events):
+        """
+        @return one shell line sending events through sendevent
+        """
+        parts = []
+        for event in events:
+            if event is None:
+                parts.append("sleep %s" % STEP_TIME)
+            else:
+                parts.append("sendevent %s %d %d %d" % ((self.path,) + event))
+        return "; ".join(parts)
+
+    def __finger(self, finger, x, y, tracking_id=None):
+        events = []
+        if self.slots:
+            events.append((EV_ABS, ABS_MT_SLOT, finger))
+        if tracking_id is not None and (self.slots or ABS_MT_TRACKING_ID in self.axes):
+            events.append((EV_ABS, ABS_MT_TRACKING_ID, tracking_id))
+        events += [(EV_ABS, ABS_MT_POSITION_X, x), (EV_ABS, ABS_MT_POSITION_Y, y)]
+        if tracking_id is not None:
+            if ABS_MT_TOUCH_MAJOR in self.axes:
+                events.append((EV_ABS, ABS_MT_TOUCH_MAJOR, _middle(self.axes[ABS_MT_TOUCH_MAJOR])))
+            if ABS_MT_PRESSURE in self.axes:
+                events.append((EV_ABS, ABS_MT_PRESSURE, _middle(self.axes[ABS_MT_PRESSURE])))
+        if not self.slots:
+            events.append((EV_SYN, SYN_MT_REPORT, 0))
+        return events
+
+
+def _middle(axis):
+    return (axis[0] + axis[1]) // 2 or 1
+
+
+def _interpolate(path, t):
+    if len(path) == 1:
+        return path[0]
+    pos = t * (len(path) - 1)
+    i = min(int(pos), len(path) - 2)
+    (x1, y1), (x2, y2) = path[i], path[i + 1]
+    f = pos - i
+    return x1 + (x2 - x1) * f, y1 + (y2 - y1) * f
+
+
+def parse_getevent(output):
+    """
+    @return list of (path, name, axes, keys, props) from `getevent -p`
+    """
+    devices = []
+    current = None
+    section = None
+    for line in output.splitlines():
+        text = line.strip()
+        if text.startswith('add device'):
+            current = [text.split()[-1], '', {}, set(), set()]
+            devices.append(current)
+            section = None
+            continue
+        if current is None:
+            continue
+        if text.startswith('name:'):
+            current[1] = text[len('name:'):].strip().strip('"')
+            continue
+        if text.startswith('input props:'):
+            section = 'PROPS'
+            continue
+        m = __section_re.match(text)
+        if m:
+            section = m.group(1)
+            text = text[m.end():]
+        if section == 'ABS':
+            for code, low, high in __abs_re.findall(text):
+                current[2][int(code, 16)] = (int(low), int(high))
+        elif section == 'KEY':
+            current[3].update(int(code, 16) for code in re.findall(r'\b[0-9a-f]{4}\b', text))
+        elif section == 'PROPS' and text.startswith('INPUT_PROP'):
+            current[4].add(text)
+    return [tuple(d) for d in devices]
+
+
+def discover(serial, port, host=None):
+    """
+    find the touchscreen node and the screen geometry in one shell round trip,
+    both stay the same for the device; the rotation does not, send() reads it again
+
+    @return TouchScreen or None when no multitouch node is visible
+    """
+    output = adb.shell(serial=serial, port=port, host=host,
+                       sh=["getevent -p 2>/dev/null; echo ATX_WM; wm size; dumpsys input | grep -m1 SurfaceOrientation"])
+    events, _, screen = output.partition("ATX_WM")
+    candidates = [d for d in parse_getevent(events)
+                  if ABS_MT_POSITION_X in d[2] and ABS_MT_POSITION_Y in d[2]]
+    if not candidates:
+        return None
+    # a direct input device is the panel, pens and touchpads come after it
+    candidates.sort(key=lambda d: 'INPUT_PROP_DIRECT' not in d[4])
+    path, name, axes, keys, _ = candidates[0]
+    sizes = dict((kind, (int(w), int(h))) for kind, w, h in __size_re.findall(screen))
+    size = sizes.get('Override') or sizes.get('Physical')
+    if size is None:
+        return None
+    m = __orientation_re.search(screen)
+    return TouchScreen(path, name, axes, keys, size, rotation=int(m.group(1)) if m else 0)
+
+
+def rotation(serial, port, host=None):
+    """
+    @return current quarter turns of the screen, None when dumpsys does not tell
+    """
+    output = adb.shell(serial=serial, port=port, host=host, sh=["dumpsys input | grep -m1 SurfaceOrientation"],
+                       timeout=adb.PROBE_TIMEOUT)
+    m = __orientation_re.search(output)
+    return int(m.group(1)) if m else None
+
+
+def send(serial, port, screen, paths, duration=0.0, host=None):
+    """
+    gesture in the current screen rotation, the app may have turned the screen since the last one
+
+    @return False when the node can not be written, e.g. no permission
+    """
+    current = rotation(serial=serial, port=port, host=host)
+    if current is not None:
+        screen.rotation = current
+    output = adb.shell(serial=serial, port=port, host=host,
+                       sh=["(%s) 2>&1" % screen.command(screen.gesture(paths, duration))])
+    return 'could not open' not in output and 'Permission denied' not in output
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+import socket
+import threading
+import time
+import unittest
+
+import atx.utils.adb as adb
+from atx.utils.adbclient import AdbClient, AdbError, ShellSession, ShellTimeoutError
+
+
+class FakeAdbServer(object):
+    """
+    answers every smart-socket request with replies[service]: OKAY, a FAIL message or None to hang up,
+    exec:sh runs a tiny shell that only knows `echo` and `sleep`
+    """
+
+    def __init__(self, replies):
+        self.replies = replies
+        self.services = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(4)
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                return
+            while True:
+                size = conn.recv(4)
+                if len(size) < 4:
+                    break
+                service = conn.recv(int(size, 16)).decode('utf-8')
+                self.services.append(service)
+                reply = self.replies.get(service, 'OKAY')
+                if reply is None:
+                    break
+                if reply != 'OKAY':
+                    conn.sendall(b'FAIL' + ('%04x' % len(reply)).encode('utf-8') + reply.encode('utf-8'))
+                    break
+                conn.sendall(b'OKAY')
+                if service == 'exec:sh':
+                    self.sh(conn)
+                    break
+            conn.close()
+
+    def sh(self, conn):
+        frame = re.compile(r'echo ATX_""B(\S+); \( (.*) \) </dev/null; echo ATX_""E\S+\$\?')
+        for line in conn.makefile('rb'):
+            m = frame.match(line.decode('utf-8'))
+            if m is None:
+                return
+            tag, command = m.groups()
+            conn.sendall(('ATX_B%s\n' % tag).encode('utf-8'))
+            name, arg = command.split(' ', 1)
+            if name == 'sleep':
+                time.sleep(float(arg))
+            else:
+                conn.sendall((arg + '\n').encode('utf-8'))
+            conn.sendall(('ATX_E%s0\n' % tag).encode('utf-8'))
+
+    def stop(self):
+        self.sock.close()
+
+
+class RunTest(unittest.TestCase):
+    def setUp(self):
+        self.forks = []
+        self.run_subprocess = getattr(adb, '__run_subprocess')
+        setattr(adb, '__run_subprocess', self.fork)
+        self.server = None
+
+    def tearDown(self):
+        setattr(adb, '__run_subprocess', self.run_subprocess)
+        if self.server is not None:
+            self.server.stop()
+
+    def fork(self, serial, port, cmd, host, stdout, stderr):
+        self.forks.append(cmd)
+        return ''
+
+    def tap(self, port):
+        return adb.run(serial='dev', port=port, cmd=['shell', 'input', 'tap', '1', '2'])
+
+    def test_no_server_uses_binary(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        self.assertEqual('', self.tap(port))
+        self.assertEqual([['shell', 'input', 'tap', '1', '2']], self.forks)
+
+    def test_fail_is_not_retried(self):
+        self.server = FakeAdbServer({'host:transport:dev': 'device offline'})
+        with self.assertRaises(AdbError) as cm:
+            self.tap(self.server.port)
+        self.assertIn('device offline', str(cm.exception))
+        self.assertEqual([], self.forks)
+
+    def test_lost_after_request_is_not_retried(self):
+        self.server = FakeAdbServer({'shell:input tap 1 2': None})
+        with self.assertRaises(AdbError):
+            self.tap(self.server.port)
+        self.assertEqual(['host:transport:dev', 'shell:input tap 1 2'], self.server.services)
+        self.assertEqual([], self.forks)
+
+
+
+class SessionTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeAdbServer({})
+        self.session = ShellSession(AdbClient(port=self.server.port), 'dev')
+
+    def tearDown(self):
+        self.session.close()
+        self.server.stop()
+
+    def test_no_limit_by_default(self):
+        self.assertEqual((0, ''), self.session.execute('sleep 0.5'))
+        self.assertEqual((0, 'hello\n'), self.session.execute('echo hello'))
+        self.assertEqual(['host:transport:dev', 'exec:sh'], self.server.services)
+
+    def test_probe_timeout(self):
+        with self.assertRaises(ShellTimeoutError):
+            self.session.execute('sleep 0.5', timeout=0.1)
+        # the hung session is dropped, the next command gets a fresh one
+        self.assertEqual((0, 'hello\n'), self.session.execute('echo hello', timeout=1))
+        self.assertEqual(2, self.server.services.count('exec:sh'))
+
+
+if __name__ == '__main__':
+    unittest.main()
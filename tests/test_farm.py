@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import cv2
+import numpy as np
+
+import atx.utils.adb as adb
+from atx.drivers.farm import FarmAgent, FarmClient, FarmController, FarmError, RemoteDevice, RemoteError
+
+
+class FakeApp(object):
+    def __init__(self, serial, screen):
+        self.serial = serial
+        self.screen = screen
+        self.taps = []
+
+    def screen_frame(self):
+        return self.screen
+
+    def tap(self, x, y):
+        self.taps.append((x, y))
+
+    def swipe(self, x1, y1, x2, y2):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeAgent(FarmAgent):
+    def __init__(self, serials, screen, token=None):
+        self.serials = serials
+        self.apps = {}
+        FarmAgent.__init__(self, ('127.0.0.1', 0), app_factory=self.new_app, token=token)
+        self.screen = screen
+
+    def new_app(self, serial):
+        self.apps[serial] = FakeApp(serial, self.screen)
+        return self.apps[serial]
+
+    def list_devices(self):
+        return [(serial, 'device') for serial in self.serials] + [('unauthorized-1', 'unauthorized')]
+
+
+class FarmTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.screen = cv2.GaussianBlur(rng.randint(0, 255, (360, 640, 3)).astype(np.uint8), (5, 5), 0)
+        self.tmp = tempfile.mkdtemp()
+        self.template = os.path.join(self.tmp, 'button.png')
+        cv2.imwrite(self.template, self.screen[100:140, 200:260])
+        self.agents = [FakeAgent(['a1', 'a2'], self.screen).start(), FakeAgent(['b1'], self.screen).start()]
+        self.farm = FarmController([('127.0.0.1', self.agents[0].port), '127.0.0.1:%d' % self.agents[1].port])
+        self.keys = []
+        self.key_event = adb.key_event
+        adb.key_event = lambda serial, port, key, instance=0, host=None: self.keys.append((serial, key))
+
+    def tearDown(self):
+        adb.key_event = self.key_event
+        for agent in self.agents:
+            agent.stop()
+        shutil.rmtree(self.tmp)
+
+    def test_primitives(self):
+        device = RemoteDevice(FarmClient('127.0.0.1', self.agents[0].port), 'a1')
+        self.assertTrue((device.screen_image(format='png') == self.screen).all())
+        self.assertEqual(self.screen.shape, device.screen_image(quality=60).shape)
+        self.assertEqual((90, 160, 3), device.screen_image(format='png', scale=0.25).shape)
+
+        pos, confidence = device.match(self.template)
+        self.assertEqual((230, 120), pos)
+        self.assertGreater(confidence, 0.99)
+        # the template went over once, the second match sends its digest only
+        self.assertEqual(1, len(device.client.sent_templates))
+        self.assertEqual(1, len(self.agents[0].templates))
+        self.assertEqual((230, 120), device.tap_image(self.template))
+        self.assertEqual([(230, 120)], self.agents[0].apps['a1'].taps)
+
+        with self.assertRaises(RemoteError):
+            device.client.call('reboot')
+        # an agent side error keeps the connection
+        self.assertEqual(['a1', 'a2', 'unauthorized-1'], [d['serial'] for d in device.client.devices()])
+        device.client.close()
+
+    def test_bad_input(self):
+        device = RemoteDevice(FarmClient('127.0.0.1', self.agents[0].port), 'a1')
+        for key in ('3; reboot', '3 && reboot', 'KEYCODE_HOME\nreboot', 'KEYCODE_HOME\n', ''):
+            with self.assertRaises(RemoteError):
+                device.key_event(key)
+        with self.assertRaises(RemoteError):
+            device.tap('1; reboot', 2)
+        with self.assertRaises(RemoteError):
+            device.swipe(1, 2, 3, '$(reboot)')
+        with self.assertRaises(RemoteError):
+            device.screen_image(format='png;reboot')
+        self.assertEqual([], self.keys)
+        self.assertEqual([], self.agents[0].apps['a1'].taps)
+        device.key_event('KEYCODE_HOME')
+        device.key_event(3)
+        self.assertEqual([('a1', 'KEYCODE_HOME'), ('a1', '3')], self.keys)
+        device.client.close()
+
+    def test_token(self):
+        agent = FakeAgent(['t1'], self.screen, token='secret').start()
+        self.agents.append(agent)
+        with self.assertRaises(FarmError):
+            FarmClient('127.0.0.1', agent.port).devices()
+        with self.assertRaises(FarmError):
+            FarmClient('127.0.0.1', agent.port, token='guess').devices()
+        self.assertEqual([], FarmController([('127.0.0.1', agent.port)]).devices())
+        devices = FarmController([('127.0.0.1', agent.port)], token='secret').devices()
+        self.assertEqual(['t1'], [d.serial for d in devices])
+        devices[0].tap(5, 6)
+        self.assertEqual([(5, 6)], agent.apps['t1'].taps)
+        devices[0].client.close()
+
+    def test_devices(self):
+        devices = self.farm.devices()
+        self.assertEqual(['a1', 'a2', 'b1'], [d.serial for d in devices])
+        self.assertEqual(3, len(set(id(d.client) for d in devices)))
+        for d in devices:
+            d.client.close()
+        self.assertEqual([], FarmController(['127.0.0.1:1']).devices())
+
+    def test_run(self):
+        def job(device):
+            device.tap(1, 2)
+            time.sleep(0.05)
+            return device.serial
+
+        def broken(device):
+            raise ValueError('broken script')
+
+        results = self.farm.run([job] * 8 + [broken])
+        self.assertEqual(list(range(9)), [r.index for r in results])
+        self.assertTrue(all(r.ok for r in results[:8]))
+        self.assertEqual(set(['a1', 'a2', 'b1']), set(r.value for r in results[:8]))
+        self.assertIsInstance(results[8].error, ValueError)
+        taps = sum(len(app.taps) for agent in self.agents for app in agent.apps.values())
+        self.assertEqual(8, taps)
+
+    def test_retry_on_lost_agent(self):
+        # b1 is slow and then loses its agent, a1 has long run out of jobs by then
+        lost = RemoteDevice(FarmClient('127.0.0.1', self.agents[1].port), 'b1')
+        alive = RemoteDevice(FarmClient('127.0.0.1', self.agents[0].port), 'a1')
+        started = threading.Event()
+
+        def job(device):
+            if device is lost:
+                started.set()
+                time.sleep(0.3)
+                self.agents[1].stop()
+                device.client.close()
+            else:
+                started.wait(5)
+            device.tap(3, 4)
+            return device.serial
+
+        results = self.farm.run([job, job], devices=[lost, alive])
+        self.assertEqual(['a1', 'a1'], [r.value for r in results])
+        self.agents.pop(1)
+
+    def test_no_device_left(self):
+        lost = RemoteDevice(FarmClient('127.0.0.1', 1), 'gone')
+        results = self.farm.run([lambda d: d.tap(1, 1)] * 2, devices=[lost])
+        self.assertTrue(all(isinstance(r.error, FarmError) for r in results))
+
+
+if __name__ == '__main__':
+    unittest.main()
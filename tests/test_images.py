@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import cv2
+import numpy as np
+
+import atx.utils.images as images
+
+
+def list_screen(rng, rows=12, size=(1080, 1920)):
+    """
+    flat white list: every row has the same icon, separator and layout, only the
+    glyphs of the "text" differ, and they wash out on a downscaled pyramid level
+    """
+    w, h = size
+    screen = np.full((h, w, 3), 250, dtype=np.uint8)
+    row_h = 130
+    top = 200
+    rects = []
+    for i in range(rows):
+        y = top + i * row_h
+        cv2.rectangle(screen, (40, y + 20), (120, y + 100), (200, 140, 60), -1)
+        x = 150
+        while x < 420:
+            glyph = rng.randint(4, 12)
+            cv2.rectangle(screen, (x, y + 40 + rng.randint(0, 4)), (x + glyph, y + 58), (60, 60, 60), -1)
+            x += glyph + rng.randint(3, 7)
+        cv2.rectangle(screen, (150, y + 75), (350 + rng.randint(0, 20), y + 88), (150, 150, 150), -1)
+        cv2.line(screen, (0, y + row_h - 1), (w, y + row_h - 1), (220, 220, 220), 2)
+        rects.append((10, y + 5, 440, y + 115))
+    return screen, rects
+
+
+def noise_screen(rng, size=(1920, 1080)):
+    w, h = size
+    return cv2.GaussianBlur(rng.randint(0, 255, (h, w, 3)).astype(np.uint8), (5, 5), 0)
+
+
+class PyramidTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = images.MATCH_ENGINE
+        images.MATCH_ENGINE = 'pyramid'
+
+    def tearDown(self):
+        images.MATCH_ENGINE = self.engine
+
+    def test_list_rows(self):
+        # similar rows: a neighbour must never win over the exact row
+        rng = np.random.RandomState(0)
+        for i in range(60):
+            screen, rects = list_screen(rng)
+            left, top, right, bottom = rects[rng.randint(len(rects))]
+            dx, dy = rng.randint(-8, 9, size=2)
+            rect = (int(left + dx), int(top + dy), int(right + dx), int(bottom + dy))
+            template = screen[rect[1]:rect[3], rect[0]:rect[2]].copy()
+            ret = images.find(template, screen)
+            self.assertIsNotNone(ret, 'case %d' % i)
+            self.assertEqual(rect, tuple(int(v) for v in ret.rect), 'case %d' % i)
+            self.assertGreater(ret.confidence, 0.99)
+
+    def test_noise(self):
+        rng = np.random.RandomState(0)
+        for i in range(20):
+            screen = noise_screen(rng)
+            h, w = rng.randint(40, 200, size=2)
+            x, y = rng.randint(0, 1920 - w), rng.randint(0, 1080 - h)
+            template = screen[y:y + h, x:x + w].copy()
+            ret = images.find(template, screen)
+            self.assertIsNotNone(ret, 'case %d' % i)
+            self.assertEqual((x, y, x + w, y + h), tuple(int(v) for v in ret.rect), 'case %d' % i)
+
+    def test_absent(self):
+        rng = np.random.RandomState(1)
+        for i in range(10):
+            screen = noise_screen(rng)
+            template = noise_screen(rng, size=(120, 80))
+            self.assertIsNone(images.find(template, screen), 'case %d' % i)
+
+
+class HintTest(unittest.TestCase):
+    def test_moved_target(self):
+        # the row was remembered at one spot, then the list scrolled: the similar
+        # row now at the remembered spot must not be taken for it
+        rng = np.random.RandomState(3)
+        screen, rects = list_screen(rng)
+        left, top, right, bottom = rects[4]
+        template = screen[top:bottom, left:right].copy()
+        memory = images.HitMemory()
+        ret = images.find_hinted(template, screen, key='row', memory=memory)
+        self.assertEqual(rects[4], tuple(int(v) for v in ret.rect))
+
+        row_h = rects[1][1] - rects[0][1]
+        scrolled = np.full_like(screen, 250)
+        scrolled[:-row_h] = screen[row_h:]
+        ret = images.find_hinted(template, scrolled, key='row', memory=memory)
+        self.assertEqual(rects[3], tuple(int(v) for v in ret.rect))
+        self.assertGreater(ret.confidence, 0.99)
+
+
+if __name__ == '__main__':
+    unittest.main()
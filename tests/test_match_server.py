@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+
+from atx.utils.match_server import LocalMatchServer, MatchClient, MatchRequestError
+
+
+class MatchServerTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.screen = cv2.GaussianBlur(rng.randint(0, 255, (720, 1280, 3)).astype(np.uint8), (5, 5), 0)
+        self.tmp = tempfile.mkdtemp()
+        self.present = os.path.join(self.tmp, 'present.png')
+        self.absent = os.path.join(self.tmp, 'absent.png')
+        cv2.imwrite(self.present, self.screen[300:380, 500:620])
+        cv2.imwrite(self.absent, cv2.GaussianBlur(rng.randint(0, 255, (80, 120, 3)).astype(np.uint8), (5, 5), 0))
+        self.displays = []
+        self.server = LocalMatchServer(self.capture).start()
+        self.client = MatchClient(port=self.server.port)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+        shutil.rmtree(self.tmp)
+
+    def capture(self, display_id):
+        self.displays.append(display_id)
+        return self.screen
+
+    def test_match(self):
+        self.assertTrue(self.client.ping())
+        self.client.load(1, self.present)
+        self.client.load(2, self.absent)
+        found, missing = self.client.match([1, 2], display_id=3)
+        self.assertEqual([3], self.displays)
+        self.assertEqual((1, True, (560, 340), (120, 80)), (found.template_id, found.found, found.pos, found.size))
+        self.assertGreater(found.confidence, 0.99)
+        self.assertEqual((2, False), (missing.template_id, missing.found))
+
+    def test_threshold(self):
+        self.client.load(1, self.present)
+        self.screen = cv2.GaussianBlur(self.screen, (9, 9), 0)
+        relaxed = self.client.match([1], threshold=0.3)[0]
+        self.assertTrue(relaxed.found)
+        strict = self.client.match([1], threshold=min(0.999, relaxed.confidence + 0.001))[0]
+        self.assertFalse(strict.found)
+
+    def test_errors_keep_connection(self):
+        with self.assertRaises(MatchRequestError):
+            self.client.load(1, os.path.join(self.tmp, 'missing.png'))
+        with self.assertRaises(MatchRequestError):
+            self.client.match([7])
+        sock = self.client._sock
+        self.assertTrue(self.client.ping())
+        self.assertIs(sock, self.client._sock)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+
+from atx.drivers import ImageCrop, Pattern
+
+
+class PatternTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.image = cv2.GaussianBlur(rng.randint(0, 255, (60, 80, 3)).astype(np.uint8), (5, 5), 0)
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'button.png')
+        cv2.imwrite(self.path, self.image)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_path_forms(self):
+        for pattern in (Pattern(self.path), Pattern('button', image=self.path)):
+            self.assertEqual(self.path, pattern.path)
+            self.assertTrue((pattern.image == self.image).all())
+            self.assertTrue((pattern.template.image == self.image).all())
+
+    def test_in_memory(self):
+        pattern = Pattern('button', image=self.image)
+        self.assertIsNone(pattern.path)
+        self.assertTrue((pattern.template.image == self.image).all())
+
+    def test_crop(self):
+        pattern = Pattern(ImageCrop(self.path, (10, 20, 30, 15)))
+        self.assertEqual((15, 30, 3), pattern.template.image.shape)
+        self.assertTrue((pattern.image == self.image[20:35, 10:40]).all())
+
+
+if __name__ == '__main__':
+    unittest.main()